@@ -0,0 +1,334 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import threading
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+from multiprocessing import cpu_count
+import numpy as np
+import milk_filter
+from milk_encoder import ENCODER_PROFILES, encoder_profile
+from milk_filter import TemporalFilter, filter_array, frame_rng
+from milk_pipeline import job_scratch, segment_video, stream_video
+from milk_converter import apply_filter_to_frames, extract_frames_with_ffmpeg, frames_to_video
+
+RESOLUTIONS = {
+    '480p': (854, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+
+def synthetic_frames(width, height, count, seed=0):
+    """Builds frames with gradients and noise, so every brightness band of both milk types shows up."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frames = []
+    for i in range(count):
+        base = (x + y) / 2 + i * 7
+        frame = np.stack([base, base * 0.8 + 30, 255 - base], axis=2) % 256
+        frame += rng.normal(0, 12, frame.shape).astype(np.float32)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+def process_tree_rss(root_pid):
+    """Resident set size in bytes of a process and all its descendants (pool workers, ffmpeg), None without /proc."""
+    parents = {}
+    rss = {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # The process name can hold spaces, the fields after it can't
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue  # Exited meanwhile
+        parents[pid] = int(fields[1])
+        rss[pid] = int(fields[21]) * page_size
+
+    total = 0
+    pending = [root_pid]
+    children = {}
+    for pid, parent in parents.items():
+        children.setdefault(parent, []).append(pid)
+    while pending:
+        pid = pending.pop()
+        total += rss.get(pid, 0)
+        pending += children.get(pid, [])
+    return total
+
+class MemorySampler:
+    """Polls the memory of this process tree while a stage runs, keeping the peak in MB (None where it can't be read).
+
+    ru_maxrss only ever grows, so it can't tell one case or stage from the ones before it.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+
+    def sample(self):
+        rss = process_tree_rss(os.getpid())
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        if not os.path.isdir('/proc'):
+            return self
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if not os.path.isdir('/proc'):
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+    @property
+    def peak_mb(self):
+        return None if self.peak is None else self.peak / (1024 * 1024)
+
+def timed(function, *args, **kwargs):
+    """Runs a function quietly, returning its wall time in seconds and the peak memory of the process tree in MB."""
+    with MemorySampler() as memory:
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    return seconds, memory.peak_mb
+
+def peak_of(*peaks):
+    """The largest of some stage peaks, None if none was measured."""
+    peaks = [peak for peak in peaks if peak is not None]
+    return max(peaks) if peaks else None
+
+def bench_filter(resolutions, milk_types, effects, frames_per_case):
+    """Measures the filter engine alone on synthetic in-memory frames."""
+    results = []
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        frames = synthetic_frames(width, height, frames_per_case)
+        for milk_type in milk_types:
+            for effect in effects:
+                filter_array(frames[0], milk_type, effect, frame_rng(0, 0))  # warm up
+
+                tracemalloc.start()
+                start = time.perf_counter()
+                for frame_num, frame in enumerate(frames):
+                    filter_array(frame, milk_type, effect, frame_rng(0, frame_num))
+                seconds = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                results.append({
+                    'name': f'filter/{resolution}/milk{milk_type}/{"pointillism" if effect else "plain"}',
+                    'frames': len(frames),
+                    'fps': len(frames) / seconds,
+                    'stages': {'filter': seconds},
+                    'peak_mb': peak / (1024 * 1024),
+                })
+                print(f"{results[-1]['name']:<40} {results[-1]['fps']:8.1f} fps")
+
+            temporal = TemporalFilter(milk_type, True, seed=0)
+            temporal.filter(frames[0])  # warm up, builds the per-pixel noise
+            start = time.perf_counter()
+            for frame in frames:
+                temporal.filter(frame)
+            seconds = time.perf_counter() - start
+            results.append({
+                'name': f'filter/{resolution}/milk{milk_type}/temporal',
+                'frames': len(frames),
+                'fps': len(frames) / seconds,
+                'stages': {'filter': seconds},
+            })
+            print(f"{results[-1]['name']:<40} {results[-1]['fps']:8.1f} fps")
+    return results
+
+def bench_encoders(filtered_folder, output_path, fps, video_path, total_frames, encoders):
+    """Measures how fast each encoder profile encodes the same filtered frames, and how big the video gets."""
+    results = []
+    for name in encoders:
+        seconds, peak = timed(frames_to_video, filtered_folder, output_path, fps, video_path, encoder=encoder_profile(name))
+        results.append({
+            'name': f'encode/{name}',
+            'frames': total_frames,
+            'fps': total_frames / seconds,
+            'stages': {'encode': seconds},
+            'size_mb': os.path.getsize(output_path) / (1024 * 1024),
+            'peak_mb': peak,
+        })
+        print(f"{results[-1]['name']:<40} {results[-1]['fps']:8.1f} fps, {results[-1]['size_mb']:.2f} MB")
+    return results
+
+def bench_video(video_path, fps, milk_types, effects, worker_counts, encoders):
+    """Measures every stage of the frame-folder pipeline, the streaming pipeline and the encoder profiles, on a real video.
+
+    Memory is the peak of the whole process tree (this process, the pool workers and ffmpeg) while each stage runs.
+    """
+    results = []
+    with job_scratch() as scratch:
+        og_folder = os.path.join(scratch, 'og')
+        filtered_folder = os.path.join(scratch, 'filtered_frames')
+        output_path = os.path.join(scratch, 'output.mp4')
+
+        extract_seconds, extract_peak = timed(extract_frames_with_ffmpeg, video_path, og_folder, fps)
+        total_frames = len([f for f in os.listdir(og_folder) if f.endswith('.jpg')])
+        if not total_frames:
+            print(f"No frames could be extracted from {video_path}, skipping the video benchmark.")
+            return results
+
+        for milk_type in milk_types:
+            for effect in effects:
+                mode = 'pointillism' if effect else 'plain'
+                for workers in worker_counts:
+                    filter_seconds, filter_peak = timed(apply_filter_to_frames, og_folder, filtered_folder, effect=effect, milk_type=milk_type, seed=0, workers=workers)
+                    encode_seconds, encode_peak = timed(frames_to_video, filtered_folder, output_path, fps, video_path)
+                    total = extract_seconds + filter_seconds + encode_seconds
+                    results.append({
+                        'name': f'video/frames/milk{milk_type}/{mode}/workers{workers}',
+                        'frames': total_frames,
+                        'fps': total_frames / total,
+                        'filter_fps': total_frames / filter_seconds,
+                        'stages': {'extract': extract_seconds, 'filter': filter_seconds, 'encode': encode_seconds},
+                        'peak_mb': peak_of(extract_peak, filter_peak, encode_peak),
+                        'stage_peak_mb': {'extract': extract_peak, 'filter': filter_peak, 'encode': encode_peak},
+                    })
+                    print(f"{results[-1]['name']:<40} {results[-1]['fps']:8.1f} fps "
+                          f"(extract {extract_seconds:.2f}s, filter {filter_seconds:.2f}s, encode {encode_seconds:.2f}s)")
+
+                for workers in worker_counts:
+                    stream_seconds, stream_peak = timed(stream_video, video_path, output_path, fps, effect=effect, milk_type=milk_type, seed=0, workers=workers)
+                    results.append({
+                        'name': f'video/stream/milk{milk_type}/{mode}/workers{workers}',
+                        'frames': total_frames,
+                        'fps': total_frames / stream_seconds,
+                        'stages': {'stream': stream_seconds},
+                        'peak_mb': stream_peak,
+                    })
+                    print(f"{results[-1]['name']:<40} {results[-1]['fps']:8.1f} fps")
+
+                    segment_seconds, segment_peak = timed(segment_video, video_path, output_path, fps, effect=effect, milk_type=milk_type, seed=0, workers=workers)
+                    results.append({
+                        'name': f'video/segments/milk{milk_type}/{mode}/workers{workers}',
+                        'frames': total_frames,
+                        'fps': total_frames / segment_seconds,
+                        'stages': {'segments': segment_seconds},
+                        'peak_mb': segment_peak,
+                    })
+                    print(f"{results[-1]['name']:<40} {results[-1]['fps']:8.1f} fps")
+
+        # The frames of the last configuration are still there, every profile encodes those
+        results += bench_encoders(filtered_folder, output_path, fps, video_path, total_frames, encoders)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def incomparable_settings(report, baseline):
+    """Lists how the machine setup of two reports differs, their numbers can't be compared if it does."""
+    differences = []
+    for key in ('engine', 'cpu_count'):
+        # Reports from before these were saved don't have them
+        if key in baseline and baseline[key] != report[key]:
+            differences.append(f"{key} {baseline[key]} -> {report[key]}")
+    return differences
+
+def compare_results(report, baseline_path, tolerance):
+    """Prints every case that got more than `tolerance` slower than the baseline, returns how many did.
+
+    Raises ValueError if the baseline ran with another filter engine or CPU count.
+    """
+    with open(baseline_path) as f:
+        baseline_report = json.load(f)
+    differences = incomparable_settings(report, baseline_report)
+    if differences:
+        raise ValueError(f"{baseline_path} was measured with a different setup ({', '.join(differences)}), not comparing")
+    baseline = {r['name']: r for r in baseline_report['results']}
+    results = report['results']
+
+    regressions = 0
+    for result in results:
+        previous = baseline.get(result['name'])
+        if not previous:
+            continue
+        change = result['fps'] / previous['fps'] - 1
+        if change < -tolerance:
+            regressions += 1
+            print(f"REGRESSION {result['name']}: {previous['fps']:.1f} -> {result['fps']:.1f} fps ({change:+.0%})")
+    print(f"Compared against {baseline_path}: {regressions} regression(s) beyond {tolerance:.0%}.")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the milk filter and the video conversion pipeline.')
+    parser.add_argument('--video', type=str, default='testVideo.mp4', help='Video used for the pipeline benchmark (default: testVideo.mp4)')
+    parser.add_argument('--fps', type=float, default=10, help='FPS used to extract frames from the video')
+    parser.add_argument('--resolutions', nargs='+', choices=RESOLUTIONS, default=['480p', '720p', '1080p'], help='Synthetic frame sizes')
+    parser.add_argument('--frames', type=int, default=20, help='Synthetic frames per case')
+    parser.add_argument('--milk-types', nargs='+', type=int, choices=[1, 2], default=[1, 2])
+    parser.add_argument('--workers', nargs='+', type=int, default=sorted({1, cpu_count()}), help='Worker counts for the pipeline benchmark')
+    parser.add_argument('--encoders', nargs='+', choices=ENCODER_PROFILES, default=list(ENCODER_PROFILES), help='Encoder profiles for the pipeline benchmark')
+    parser.add_argument('--skip-video', action='store_true', help='Only benchmark the filter on synthetic frames')
+    parser.add_argument('--output', type=str, default='bench_results.json', help='Where to save the results')
+    parser.add_argument('--compare', type=str, default=None, help='Previous results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed fps drop against --compare before failing (default: 0.15)')
+    args = parser.parse_args()
+
+    effects = [False, True]
+    engine = 'native' if milk_filter.milk_native is not None else 'numpy'
+    print(f"Filter engine: {engine}, {cpu_count()} CPUs")
+
+    results = bench_filter(args.resolutions, args.milk_types, effects, args.frames)
+    if args.skip_video:
+        pass
+    elif not shutil.which('ffmpeg'):
+        print("ffmpeg not found, skipping the video benchmark.")
+    elif not os.path.exists(args.video):
+        print(f"{args.video} not found, skipping the video benchmark.")
+    else:
+        results += bench_video(args.video, args.fps, args.milk_types, effects, args.workers, args.encoders)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'engine': engine,
+        'cpu_count': cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        try:
+            regressions = compare_results(report, args.compare, args.tolerance)
+        except ValueError as error:
+            sys.exit(str(error))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
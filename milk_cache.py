@@ -0,0 +1,157 @@
+import os
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+import numpy as np
+import milk_filter
+from milk_filter import compress_array, filter_indices, frame_rng, milk_lookup, milk_palette
+
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+
+# Bump when the filter output changes, so entries written by older versions are never hit
+CACHE_VERSION = 2
+
+def default_cache_dir():
+    """The per-user cache folder, MILK_CACHE_DIR overrides it."""
+    if os.environ.get('MILK_CACHE_DIR'):
+        return os.environ['MILK_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'milk-video-converter')
+
+class FrameCache:
+    """Filtered frames on disk, keyed by a hash of the input pixels and of everything the output depends on.
+
+    Entries are raw .npy arrays of palette indices, which load faster than the filter runs. Once the folder grows past
+    `max_bytes` the least recently used entries are deleted. Several processes (and threads) can share one folder.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_SIZE, memory_entries=8):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.recent = OrderedDict()
+        self.recent_lock = threading.Lock()
+        self.added_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def settings_key(self, compression, effect, milk_type, quality, seed, frame_num, temporal=None):
+        """Hashes the filter settings, or returns None when the output isn't reproducible."""
+        lookup = milk_lookup(milk_type, effect)
+        parts = [CACHE_VERSION, lookup.main.tobytes(), lookup.palette.tobytes(), quality if compression else None]
+        if effect and temporal is not None:
+            # Temporal dithering only depends on the pixels and the seed, duplicates anywhere in the video match
+            parts += [lookup.dithered.tobytes(), lookup.band.tobytes(), milk_filter.POINTILLISM_PROBABILITY, 'temporal', temporal.seed]
+        elif effect:
+            if seed is None:
+                return None
+            # Dithering depends on the frame's own generator, and the two engines draw differently
+            engine = 'native' if milk_filter.milk_native is not None else 'numpy'
+            parts += [lookup.dithered.tobytes(), milk_filter.POINTILLISM_PROBABILITY, engine, seed, frame_num]
+        return hashlib.sha256(repr(parts).encode()).digest()
+
+    def key(self, frame, compression, effect, milk_type, quality, seed=None, frame_num=0, temporal=None):
+        settings = self.settings_key(compression, effect, milk_type, quality, seed, frame_num, temporal)
+        if settings is None:
+            return None
+        # SHA-256 is hardware accelerated on most CPUs, faster here than blake2b or md5
+        digest = hashlib.sha256(settings)
+        digest.update(repr(frame.shape).encode())
+        digest.update(np.ascontiguousarray(frame).data)
+        return digest.hexdigest()[:40]
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.npy')
+
+    def get(self, key):
+        with self.recent_lock:
+            if key in self.recent:
+                self.recent.move_to_end(key)
+                return self.recent[key]
+        path = self.entry_path(key)
+        try:
+            frame = np.load(path)
+            os.utime(path)  # Marks it as recently used for eviction
+        except (OSError, ValueError):
+            return None
+        self.remember(key, frame)
+        return frame
+
+    def put(self, key, frame):
+        self.remember(key, frame)
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(temp_path, 'wb') as f:
+            np.save(f, frame)
+        os.replace(temp_path, path)
+
+        self.added_bytes += os.path.getsize(path)
+        if self.added_bytes > self.max_bytes // 10:
+            self.evict()
+
+    def remember(self, key, frame):
+        """Keeps the last few frames in memory, so a run of identical frames doesn't even touch the disk."""
+        with self.recent_lock:
+            self.recent[key] = frame
+            self.recent.move_to_end(key)
+            while len(self.recent) > self.memory_entries:
+                self.recent.popitem(last=False)
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in `max_bytes`."""
+        self.added_bytes = 0
+        entries = []
+        for folder in os.scandir(self.path):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Evicted by another process meanwhile
+            total -= size
+
+    def filter(self, frame, compression, effect, milk_type, quality, seed=None, frame_num=0, temporal=None, indexed=False):
+        """Same as compressing and filtering `frame` (with a TemporalFilter if given), reusing the cached result when there is one.
+
+        Returns palette indices like filter_indices when `indexed`, RGB like filter_array otherwise.
+        """
+        indices = self.filter_indices(frame, compression, effect, milk_type, quality, seed, frame_num, temporal)
+        return indices if indexed else np.take(milk_palette(milk_type), indices, axis=0)
+
+    def filter_indices(self, frame, compression, effect, milk_type, quality, seed=None, frame_num=0, temporal=None):
+        key = self.key(frame, compression, effect, milk_type, quality, seed, frame_num, temporal)
+        if key is not None:
+            cached = self.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        self.misses += 1
+
+        if compression:
+            frame = compress_array(frame, quality)
+        if temporal is not None:
+            indices = temporal.filter_indices(frame)
+        else:
+            indices = filter_indices(frame, milk_type, effect, frame_rng(seed, frame_num))
+        if key is not None:
+            self.put(key, indices)
+        return indices
+
+@functools.lru_cache(maxsize=None)
+def get_frame_cache(path, max_bytes=DEFAULT_CACHE_SIZE):
+    """One FrameCache per folder and process, so its in-memory entries last across chunks."""
+    return FrameCache(path, max_bytes)
@@ -0,0 +1,341 @@
+import os
+import shutil
+import itertools
+import tempfile
+from collections import namedtuple
+from multiprocessing import cpu_count
+import numpy as np
+from PIL import Image
+from milk_cache import DEFAULT_CACHE_SIZE
+from milk_encoder import encoder_args
+from milk_filter import milk_palette, palette_image
+from milk_pipeline import DEFAULT_CHUNK_SIZE, ExecutorPool, FilterSettings, ffmpeg_palette, filter_frame_indices, frame_chunks, get_frame_pool, job_scratch, open_encoder, pipe_stream, remove_output, segment_video, settings_cache, settings_temporal_filter, shared_settings, shutdown_frame_pool, stream_video, worker_temporal_filter
+from milk_probe import probe_video
+from milk_profile import stage, start_profiling, stop_profiling
+from milk_progress import ProgressTracker, run_ffmpeg_with_progress
+from milk_resume import ResumeManifest, filter_signature, resumable_scratch, save_atomically, source_signature
+
+# Frame rate of the videos made from in-memory frames when the options don't set one
+DEFAULT_FPS = 25
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+# How a video file is converted: piping frames between ffmpeg processes (stream_video), in segments
+# split at keyframes (segment_video) or through folders of frames on disk, like the original converter
+CONVERT_MODES = ('stream', 'segments', 'frames')
+
+# Everything a conversion can be told. `fps` defaults to the video's own, `encoder` is an encoder
+# profile (see milk_encoder) and `resume` only applies to the 'frames' mode. `profile` is where to
+# save a Chrome trace of the run, with cProfile stats next to it if `profile_python` (see milk_profile).
+ConvertOptions = namedtuple('ConvertOptions', [
+    'milk_type', 'effect', 'compression', 'quality', 'seed', 'temporal', 'fps', 'mode', 'workers', 'segments',
+    'chunk_size', 'cache_dir', 'cache_size', 'encoder', 'scratch_root', 'resume', 'profile', 'profile_python',
+], defaults=(1, False, False, 90, None, False, None, 'stream', None, None, DEFAULT_CHUNK_SIZE, None, DEFAULT_CACHE_SIZE, None, None, False, None, False))
+
+def empty_folder(folder):
+    """Creates `folder`, or deletes everything in it if it already exists."""
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+        return
+    for filename in os.listdir(folder):
+        file_path = os.path.join(folder, filename)
+        if os.path.isfile(file_path) or os.path.islink(file_path):
+            os.unlink(file_path)
+        elif os.path.isdir(file_path):
+            shutil.rmtree(file_path)
+
+def extract_frames_with_ffmpeg(video_path, output_folder, fps, progress_callback=None, control=None):
+    """Extracts frames from a video file using ffmpeg."""
+    empty_folder(output_folder)
+    duration = probe_video(video_path).duration
+    command = ['ffmpeg', '-y', '-i', video_path, '-vf', f'fps={fps}', os.path.join(output_folder, 'frame%06d.jpg')]
+    run_ffmpeg_with_progress(command, ProgressTracker('extract', int(duration * fps), progress_callback), control)
+
+def apply_filter_to_frame_range(start, end, input_folder, output_folder, settings):
+    """Applies the filter (FilterSettings) to a range of frames and saves them to the output folder, returning the frames filtered."""
+    cache = settings_cache(settings)
+    temporal_filter = settings_temporal_filter(settings)
+    filtered = []
+    for frame_num in range(start, end):
+        frame_path = os.path.join(input_folder, f"frame{frame_num:06d}.jpg")
+        if os.path.exists(frame_path):
+            with stage('read', frame=frame_num):
+                frame = np.asarray(Image.open(frame_path).convert('RGB'))
+            indices = filter_frame_indices(frame, frame_num, settings, cache, temporal_filter)
+            # Filtered frames are palette PNGs: lossless, a few colours packed at 2 or 4 bits per pixel, and
+            # the fastest zlib level already shrinks them several times over for little more time than none
+            filtered_frame_path = os.path.join(output_folder, f"frame{frame_num:06d}.png")
+            with stage('write', frame=frame_num):
+                save_atomically(palette_image(indices, settings.milk_type), filtered_frame_path, format='PNG', compress_level=1)
+            filtered.append(frame_num)
+    return filtered
+
+def apply_filter_to_frames(input_folder, output_folder, compression=False, effect=False, milk_type=1, quality=90, seed=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None, control=None, manifest=None, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, temporal=False, pool=None):
+    """Applies the custom filter to each extracted frame and saves them to the output folder.
+
+    With a ResumeManifest, frames already filtered with the same settings are kept and skipped.
+    With a `cache_dir`, frames already filtered in this run or an earlier one are taken from the FrameCache.
+    With `temporal`, the pointillism pattern stays put wherever the video doesn't change (see TemporalFilter).
+    The chunks run on `pool`, the shared frame pool with `workers` workers by default.
+    """
+    settings = FilterSettings(compression, effect, milk_type, quality, seed, cache_dir, cache_size, temporal)
+    # A resumed run has to dither like the run before it
+    settings = shared_settings(settings, manifest.temporal_seed) if manifest is not None else shared_settings(settings)
+
+    done = set()
+    if manifest is not None:
+        signature = filter_signature(manifest.source, compression, effect, milk_type, quality, settings.seed, temporal)
+        done = manifest.filtered_frames(signature, input_folder, output_folder)
+    else:
+        empty_folder(output_folder)
+
+    frame_files = [f for f in os.listdir(input_folder) if f.endswith('.jpg')]
+    frame_files.sort(key=lambda x: int(x[5:-4]))
+    total_frames = len(frame_files)
+
+    frame_numbers = [int(f[5:-4]) for f in frame_files if int(f[5:-4]) not in done]
+    chunks = [(start, end, input_folder, output_folder, settings) for start, end in frame_chunks(frame_numbers, chunk_size)]
+
+    # Workers pull chunks as they free up, so a heavy stretch of frames doesn't leave the other cores idle
+    tracker = ProgressTracker('filter', total_frames, progress_callback)
+    pool = pool or get_frame_pool(workers)
+    filtered_frames = len(done)
+    try:
+        for filtered in pool.imap(apply_filter_to_frame_range, chunks, control):
+            filtered_frames += len(filtered)
+            if manifest is not None:
+                manifest.mark_filtered(filtered)
+            tracker.update(filtered_frames, pool.queue_depth())
+    finally:
+        # Also on a crash or a kill, so the next run knows about every finished chunk
+        if manifest is not None:
+            manifest.save()
+    tracker.finish(filtered_frames)
+
+def frames_to_video(input_folder, output_path, fps, original_video_path, progress_callback=None, control=None, encoder=None):
+    """Converts a sequence of frames into a video file using ffmpeg (with an encoder profile) and retains the original audio."""
+    frame_files = [f for f in os.listdir(input_folder) if f.endswith(('.jpg', '.png'))]
+
+    if not frame_files:
+        raise RuntimeError(f"No frames found in {input_folder}")
+
+    # Ensure the frames are sorted correctly
+    frame_files.sort(key=lambda x: int(x[5:-4]))
+
+    # Paths in the list are relative to the list itself, which lives next to the frames
+    list_path = os.path.join(input_folder, 'frames.txt')
+    with open(list_path, 'w') as f:
+        for frame_file in frame_files:
+            f.write(f"file '{frame_file}'\n")
+
+    command = [
+        'ffmpeg',
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-r', str(fps),
+        '-i', list_path,
+        '-i', original_video_path,
+        '-map', '0:v',
+        '-map', '1:a?',
+        *encoder_args(encoder),
+        '-shortest',  # Ensure the video and audio lengths match
+        output_path
+    ]
+
+    try:
+        run_ffmpeg_with_progress(command, ProgressTracker('encode', len(frame_files), progress_callback), control)
+    except BaseException:
+        # A cancelled or failed ffmpeg leaves a truncated video
+        remove_output(output_path)
+        raise
+    os.remove(list_path)
+
+def as_frame(frame):
+    """Turns an RGB array, a PIL image or the path of an image file into a (height, width, 3) uint8 array."""
+    if isinstance(frame, (str, os.PathLike)):
+        with Image.open(frame) as image:
+            return np.asarray(image.convert('RGB'))
+    if isinstance(frame, Image.Image):
+        return np.asarray(frame.convert('RGB'))
+    frame = np.asarray(frame, dtype=np.uint8)
+    if frame.ndim != 3 or frame.shape[2] < 3:
+        raise ValueError(f"A frame must be a (height, width, 3) RGB array, not {frame.shape}")
+    return frame
+
+def filter_settings(options):
+    """The FilterSettings part of ConvertOptions."""
+    return FilterSettings(*(getattr(options, field) for field in FilterSettings._fields))
+
+def _filter_frame(frame, frame_num, settings):
+    """Pool task: filters one in-memory frame into palette indices."""
+    return frame_num, filter_frame_indices(frame, frame_num, settings, settings_cache(settings), worker_temporal_filter(settings))
+
+class MilkConverter:
+    """The converter as a library: filters frames in memory and converts videos, images or frame sequences.
+
+    `options` are the ConvertOptions used unless a call gives its own. The filter runs on `executor`:
+    a FramePool or any concurrent.futures executor (threads or processes). Without one it runs on the
+    shared frame pool, or in this process with a single worker.
+    """
+
+    def __init__(self, options=None, executor=None):
+        self.options = self.resolve_options(options or ConvertOptions())
+        # Used by filter_indices and filter_frames, whose frames all dither from the same noise on any worker and in any call.
+        # A conversion picks its own seed, a resumed one the seed of the run before it
+        self.settings = shared_settings(filter_settings(self.options))
+        if executor is not None and not hasattr(executor, 'imap'):
+            executor = ExecutorPool(executor, self.options.workers)
+        self.pool = executor
+
+    def resolve_options(self, options=None):
+        if options is None:
+            return self.options
+        if options.mode not in CONVERT_MODES:
+            raise ValueError(f"Unknown mode {options.mode!r}, choose one of: {', '.join(CONVERT_MODES)}")
+        return options
+
+    def filter_pool(self, options):
+        """The pool that filters in-memory frames, None to filter them in this process."""
+        if self.pool is not None:
+            return self.pool
+        workers = options.workers or cpu_count()
+        return get_frame_pool(workers) if workers > 1 else None
+
+    def filter_indices(self, frame, frame_num=1):
+        """Filters one frame (an RGB array, PIL image or image path) into (height, width) indices into milk_palette.
+
+        `frame_num` picks the frame's pointillism pattern when the options have a seed. Safe to call
+        from several threads, each one gets its own TemporalFilter.
+        """
+        settings = self.settings
+        return filter_frame_indices(as_frame(frame), frame_num, settings, settings_cache(settings), worker_temporal_filter(settings))
+
+    def filter_frame(self, frame, frame_num=1):
+        """Same as filter_indices, but returns the filtered (height, width, 3) RGB array."""
+        return np.take(milk_palette(self.options.milk_type), self.filter_indices(frame, frame_num), axis=0)
+
+    def filter_frames(self, frames, first_frame=1, indexed=False, control=None):
+        """Filters a batch ((count, height, width, 3) array) or an iterable of frames, yielding them in order.
+
+        Frames are spread over the executor's workers. Yields RGB arrays, or palette indices when `indexed`.
+        """
+        palette = milk_palette(self.options.milk_type)
+        for _, indices in self.indexed_frames(frames, self.settings, self.filter_pool(self.options), first_frame, control):
+            yield indices if indexed else np.take(palette, indices, axis=0)
+
+    def indexed_frames(self, frames, settings, pool, first_frame=1, control=None):
+        """Yields (frame number, palette indices) for every frame, filtered with FilterSettings on `pool` or in this process without one."""
+        frames = (as_frame(frame) for frame in frames)
+        settings = shared_settings(settings)
+        if pool is None:
+            cache = settings_cache(settings)
+            temporal_filter = settings_temporal_filter(settings)
+            for frame_num, frame in enumerate(frames, start=first_frame):
+                if control is not None:
+                    control.checkpoint()
+                yield frame_num, filter_frame_indices(frame, frame_num, settings, cache, temporal_filter)
+            return
+
+        tasks = ((frame, frame_num, settings) for frame_num, frame in enumerate(frames, start=first_frame))
+        filtered = {}
+        next_frame = first_frame
+        for frame_num, indices in pool.imap(_filter_frame, tasks, control):
+            filtered[frame_num] = indices
+            while next_frame in filtered:
+                yield next_frame, filtered.pop(next_frame)
+                next_frame += 1
+
+    def convert(self, src, dst, options=None, progress_callback=None, control=None):
+        """Filters `src` into the file `dst`.
+
+        `src` is the path of a video or an image, or in-memory frames (a (count, height, width, 3)
+        array or an iterable of arrays, PIL images or image paths) encoded into a video without audio.
+        With `options.profile`, returns the stage_summary of the run.
+        """
+        options = self.resolve_options(options)
+        if options.profile:
+            return self.convert_profiled(src, dst, options, progress_callback, control)
+        self.run_conversion(src, dst, options, progress_callback, control)
+
+    def convert_profiled(self, src, dst, options, progress_callback=None, control=None):
+        """Runs convert while every process records its stages, see milk_profile."""
+        start_profiling(options.profile_python)
+        try:
+            with stage('convert'):
+                self.run_conversion(src, dst, options, progress_callback, control)
+        finally:
+            if self.pool is None:
+                # Its workers write out the last of their profile as they exit, and the next run gets unprofiled ones
+                shutdown_frame_pool()
+            summary = stop_profiling(options.profile)
+        return summary
+
+    def run_conversion(self, src, dst, options, progress_callback=None, control=None):
+        if not isinstance(src, (str, os.PathLike)):
+            self.encode_frames(src, dst, options, progress_callback, control)
+        elif os.fspath(src).lower().endswith(IMAGE_EXTENSIONS):
+            _, indices = next(self.indexed_frames([src], filter_settings(options), None))
+            Image.fromarray(np.take(milk_palette(options.milk_type), indices, axis=0)).save(dst)
+        else:
+            self.convert_video(src, dst, options, progress_callback, control)
+
+    def encode_frames(self, frames, output_path, options, progress_callback=None, control=None):
+        """Filters in-memory frames into a video at `options.fps` (DEFAULT_FPS if not set)."""
+        total_frames = len(frames) if hasattr(frames, '__len__') else 0
+        frames = iter(frames)
+        first = next(frames, None)
+        if first is None:
+            raise ValueError("No frames to convert")
+        first = as_frame(first)
+        height, width = first.shape[:2]
+        tracker = ProgressTracker('encode', total_frames, progress_callback)
+        # Before starting ffmpeg, like stream_video
+        pool = self.filter_pool(options)
+
+        with tempfile.TemporaryFile() as encoder_log:
+            encoder = open_encoder(output_path, options.fps or DEFAULT_FPS, width, height, None, options.encoder, encoder_log, pix_fmt='pal8')
+            filtered = self.indexed_frames(itertools.chain([first], frames), filter_settings(options), pool, control=control)
+            frames_written = pipe_stream(None, None, encoder, encoder_log, filtered, ffmpeg_palette(milk_palette(options.milk_type)), output_path, tracker, control)
+        tracker.finish(frames_written)
+
+    def convert_video(self, video_path, output_path, options, progress_callback=None, control=None):
+        """Filters a video file the way `options.mode` says, keeping its audio."""
+        fps = options.fps or probe_video(video_path).fps
+        settings = dict(compression=options.compression, effect=options.effect, milk_type=options.milk_type, quality=options.quality, seed=options.seed,
+                        progress_callback=progress_callback, control=control, cache_dir=options.cache_dir, cache_size=options.cache_size,
+                        temporal=options.temporal, encoder=options.encoder, workers=options.workers, pool=self.pool)
+        if options.mode == 'stream':
+            stream_video(video_path, output_path, fps, **settings)
+        elif options.mode == 'segments':
+            segment_video(video_path, output_path, fps, segments=options.segments, scratch_root=options.scratch_root, **settings)
+        else:
+            self.convert_frames(video_path, output_path, fps, options, progress_callback, control)
+
+    def convert_frames(self, video_path, output_path, fps, options, progress_callback=None, control=None):
+        """The original converter: extracts the frames to a scratch folder, filters them there and encodes them again."""
+        # Every conversion gets its own scratch folder, so several can run from the same directory
+        scratch_folder = resumable_scratch(video_path, options.scratch_root) if options.resume else job_scratch(options.scratch_root)
+        with scratch_folder as scratch:
+            og_folder = os.path.join(scratch, 'og')
+            filtered_folder = os.path.join(scratch, 'filtered_frames')
+            manifest = ResumeManifest(scratch) if options.resume else None
+
+            source = source_signature(video_path, fps)
+            if manifest is not None and manifest.extraction_done(source, og_folder):
+                extracted = len([f for f in os.listdir(og_folder) if f.endswith('.jpg')])
+                ProgressTracker('extract', extracted, progress_callback).skip(extracted)
+            else:
+                extract_frames_with_ffmpeg(video_path, og_folder, fps, progress_callback, control)
+                if manifest is not None:
+                    manifest.mark_extracted(source)
+
+            apply_filter_to_frames(og_folder, filtered_folder, compression=options.compression, effect=options.effect, milk_type=options.milk_type,
+                                   quality=options.quality, seed=options.seed, workers=options.workers, chunk_size=options.chunk_size,
+                                   progress_callback=progress_callback, control=control, manifest=manifest, cache_dir=options.cache_dir,
+                                   cache_size=options.cache_size, temporal=options.temporal, pool=self.pool)
+
+            if manifest is None:
+                shutil.rmtree(og_folder)
+
+            frames_to_video(filtered_folder, output_path, fps, video_path, progress_callback, control, options.encoder)
@@ -0,0 +1,55 @@
+DEFAULT_ENCODER = 'x264'
+
+# Encoder profiles for the filtered video. Settings left out use the encoder's own default,
+# `audio` is an ffmpeg audio codec or 'copy' to keep the original audio stream untouched.
+ENCODER_PROFILES = {
+    # What the converter always used: libx264 with its default preset and CRF
+    'x264': {'codec': 'libx264', 'preset': 'medium', 'crf': 23, 'pix_fmt': 'yuv420p'},
+    # The milk palette is a few flat colours, which the animation tune and a fast preset handle well
+    'x264-fast': {'codec': 'libx264', 'preset': 'veryfast', 'crf': 23, 'tune': 'animation', 'pix_fmt': 'yuv420p'},
+    # Smaller files for the same quality, slower to encode
+    'x265': {'codec': 'libx265', 'preset': 'medium', 'crf': 28, 'pix_fmt': 'yuv420p', 'tag': 'hvc1'},
+    'vp9': {'codec': 'libvpx-vp9', 'crf': 32, 'pix_fmt': 'yuv420p', 'audio': 'libopus',
+            'extra': ['-b:v', '0', '-row-mt', '1', '-deadline', 'good', '-cpu-used', '4']},
+    # Exact palette colours (no chroma subsampling), for editing the video afterwards
+    'lossless': {'codec': 'libx264rgb', 'preset': 'veryfast', 'crf': 0, 'pix_fmt': 'rgb24'},
+}
+
+def encoder_profile(name=DEFAULT_ENCODER, preset=None, crf=None, tune=None, threads=None, audio=None):
+    """Returns the settings of an encoder profile, with any of them overridden."""
+    if name not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile {name!r}, choose one of: {', '.join(ENCODER_PROFILES)}")
+    profile = dict(ENCODER_PROFILES[name])
+    overrides = {'preset': preset, 'crf': crf, 'tune': tune, 'threads': threads, 'audio': audio}
+    profile.update({key: value for key, value in overrides.items() if value is not None})
+    return profile
+
+def encoder_args(profile=None):
+    """Turns an encoder profile into ffmpeg output options, for the video and the audio streams."""
+    if profile is None:
+        profile = encoder_profile()
+    args = ['-c:v', profile['codec']]
+    if profile.get('preset'):
+        args += ['-preset', profile['preset']]
+    if profile.get('crf') is not None:
+        args += ['-crf', str(profile['crf'])]
+    if profile.get('tune'):
+        args += ['-tune', profile['tune']]
+    if profile.get('threads'):
+        args += ['-threads', str(profile['threads'])]
+    args += ['-pix_fmt', profile['pix_fmt']]
+    args += profile.get('extra', [])
+    if profile.get('tag'):
+        args += ['-tag:v', profile['tag']]
+    args += ['-c:a', profile.get('audio', 'copy')]
+    return args
+
+def remux_args(profile=None):
+    """ffmpeg output options that copy video already encoded with a profile, encoding the audio like it would."""
+    if profile is None:
+        profile = encoder_profile()
+    args = ['-c:v', 'copy']
+    if profile.get('tag'):
+        args += ['-tag:v', profile['tag']]
+    args += ['-c:a', profile.get('audio', 'copy')]
+    return args
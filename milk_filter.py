@@ -0,0 +1,258 @@
+import io
+import os
+import json
+import functools
+from collections import namedtuple
+import numpy as np
+from PIL import Image
+
+# Native kernel built from milk_native.cpp (see CMakeLists.txt), the NumPy engine is used when it's
+# missing. Set MILK_DISABLE_NATIVE=1 to force the NumPy engine.
+try:
+    if os.environ.get('MILK_DISABLE_NATIVE'):
+        raise ImportError
+    import milk_native
+except ImportError:
+    milk_native = None
+
+# Threads used by the native kernel for each frame, 0 means one per core
+native_threads = 0
+
+# Probability of keeping a band's main colour when the pointillism effect is on.
+POINTILLISM_PROBABILITY = 0.7
+
+MILK_PALETTES = {
+    1: ((0, 0, 0), (102, 0, 31), (137, 0, 146)),
+    2: ((0, 0, 0), (92, 36, 60), (203, 43, 43)),
+}
+
+# Brightness bands as (upper bound of R+G+B, main colour, dithered colour).
+# Working on the channel sum keeps the original `sum([R, G, B]) / 3` thresholds
+# exact without any float math: brightness <= 25 is sum < 76, < 120 is sum < 360...
+MILK_BANDS = {
+    1: ((76, 0, 0), (211, 0, 1), (360, 1, 0), (600, 1, 1), (690, 2, 1), (766, 2, 2)),
+    2: ((76, 0, 0), (211, 0, 1), (270, 1, 0), (450, 1, 1), (600, 2, 1), (766, 2, 2)),
+}
+
+# Largest possible R+G+B, lookup tables have one entry per sum
+MAX_SUM = 765
+
+# Lookup tables of one filter configuration, all indexed by R+G+B: `main` and `dithered` are
+# palette indices, `colours` is `palette[main]` so a frame without dithering is a single gather,
+# and `band` is the brightness band the sum falls in.
+MilkLookup = namedtuple('MilkLookup', ['main', 'dithered', 'palette', 'colours', 'band'])
+
+# The native kernel's dither: a splitmix64 generator per row, seeded with the frame's seed and the row
+# times ROW_STEP, and 32 bits of it per pixel that can get either colour. The NumPy engine draws the
+# same numbers, so a seeded video is the same with either engine.
+SPLITMIX_STEP = np.uint64(0x9E3779B97F4A7C15)
+ROW_STEP = np.uint64(0xD1B54A32D192ED03)
+KEEP_THRESHOLD = np.uint32(POINTILLISM_PROBABILITY * 2**32)
+
+# Added to the per-pixel noise once per band in temporal mode, so a pixel gets a new dither
+# decision when it moves to another band (golden ratio steps keep the decisions well spread).
+# All in 32-bit integers, so the NumPy and native engines give the same output.
+BAND_STEP = np.uint32(0x9E3779B9)
+
+def register_milk_type(milk_type, palette, bands):
+    """Adds (or replaces) a milk type given its palette colours and its brightness bands."""
+    palette = tuple(tuple(int(c) for c in colour) for colour in palette)
+    bands = tuple(tuple(int(v) for v in band) for band in bands)
+
+    if not 0 < len(palette) <= 256 or any(len(colour) != 3 or not all(0 <= c <= 255 for c in colour) for colour in palette):
+        raise ValueError(f"Milk type {milk_type}: the palette needs 1 to 256 RGB colours with values 0-255")
+    uppers = [band[0] for band in bands]
+    if not bands or any(len(band) != 3 for band in bands) or uppers != sorted(uppers) or uppers[-1] <= MAX_SUM:
+        raise ValueError(f"Milk type {milk_type}: bands must be increasing (upper sum, main, dithered) triples ending above {MAX_SUM}")
+    if any(not 0 <= index < len(palette) for band in bands for index in band[1:]):
+        raise ValueError(f"Milk type {milk_type}: band colours must be indices into the palette")
+
+    MILK_PALETTES[milk_type] = palette
+    MILK_BANDS[milk_type] = bands
+    milk_lookup.cache_clear()
+
+def load_milk_types(path):
+    """Registers the milk types of a JSON file like {"3": {"palette": [[r, g, b], ...], "bands": [[upper, main, dithered], ...]}}."""
+    with open(path) as f:
+        for milk_type, definition in json.load(f).items():
+            register_milk_type(int(milk_type), definition['palette'], definition['bands'])
+
+@functools.lru_cache(maxsize=None)
+def milk_lookup(milk_type, effect):
+    """Builds (once per configuration) the read-only lookup tables of a milk type."""
+    # Unknown milk types fall back to type 2, like the original if/else did
+    key = milk_type if milk_type in MILK_PALETTES else 2
+    palette = np.array(MILK_PALETTES[key], dtype=np.uint8)
+    bands = np.array(MILK_BANDS[key], dtype=np.int64)
+
+    band = np.searchsorted(bands[:, 0], np.arange(MAX_SUM + 1), side='right')
+    main = bands[:, 1][band].astype(np.uint8)
+    # Without pointillism the dithered colour never shows up
+    dithered = bands[:, 2][band].astype(np.uint8) if effect else main.copy()
+    colours = palette[main]
+
+    band = band.astype(np.uint16)
+
+    for table in (main, dithered, palette, colours, band):
+        table.setflags(write=False)
+    return MilkLookup(main, dithered, palette, colours, band)
+
+# Extra milk types for every process, spawned workers included
+if os.environ.get('MILK_PALETTES'):
+    load_milk_types(os.environ['MILK_PALETTES'])
+
+def frame_rng(seed=None, frame_num=0):
+    """Returns the random generator for a frame, reproducible when `seed` is given."""
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, frame_num])
+
+def random_seed():
+    """A fresh seed, for runs where every process has to use the same one."""
+    return int(np.random.SeedSequence().generate_state(1)[0])
+
+def compress_array(frame, calidad):
+    """Gives a frame the JPEG compression look with an in-memory encode/decode round trip."""
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format='JPEG', quality=100-calidad)
+    buffer.seek(0)
+    return np.asarray(Image.open(buffer).convert('RGB'))
+
+def set_native_threads(threads):
+    """Sets how many threads the native kernel uses per frame (worker processes use 1)."""
+    global native_threads
+    native_threads = threads
+
+def dither_keep(ditherable, seed):
+    """Draws, like the native kernel, whether each pixel where `ditherable` is set keeps its main colour."""
+    # The n-th draw of a row is its n-th pixel that can get either colour, two of them per 64-bit number
+    draw = np.cumsum(ditherable, axis=1, dtype=np.uint32)[ditherable].astype(np.uint64)
+    draw -= np.uint64(1)
+    state = np.nonzero(ditherable)[0].astype(np.uint64)
+    state *= ROW_STEP
+    state ^= np.uint64(seed)
+    # splitmix64 adds SPLITMIX_STEP to its state before each number, so the n-th comes straight from the row's seed
+    z = draw >> np.uint64(1)
+    z += np.uint64(1)
+    z *= SPLITMIX_STEP
+    z += state
+    z ^= z >> np.uint64(30)
+    z *= np.uint64(0xBF58476D1CE4E5B9)
+    z ^= z >> np.uint64(27)
+    z *= np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    # Low half first
+    z >>= (draw & np.uint64(1)) << np.uint64(5)
+    return z.astype(np.uint32) < KEEP_THRESHOLD
+
+def filter_array(frame, milk_type=1, effect=False, rng=None):
+    """Maps a (height, width, 3) RGB array onto the milk palette."""
+    lookup = milk_lookup(milk_type, effect)
+
+    if effect and rng is None:
+        rng = np.random.default_rng()
+
+    if milk_native is not None:
+        seed = int(rng.integers(2**63)) if effect else 0
+        return milk_native.filter_frame(frame, lookup.main, lookup.dithered, lookup.palette, effect, seed, native_threads)
+
+    total = frame[..., :3].sum(axis=2, dtype=np.uint16)
+    if not effect:
+        return lookup.colours[total]
+    return lookup.palette[dither_indices(lookup, total, int(rng.integers(2**63)))]
+
+def filter_indices(frame, milk_type=1, effect=False, rng=None):
+    """Same as filter_array, but returns the (height, width) uint8 indices into `milk_palette(milk_type)`."""
+    lookup = milk_lookup(milk_type, effect)
+
+    if effect and rng is None:
+        rng = np.random.default_rng()
+
+    if milk_native is not None:
+        seed = int(rng.integers(2**63)) if effect else 0
+        return milk_native.filter_frame(frame, lookup.main, lookup.dithered, lookup.palette, effect, seed, native_threads, indexed=True)
+
+    total = frame[..., :3].sum(axis=2, dtype=np.uint16)
+    if not effect:
+        return lookup.main[total]
+    return dither_indices(lookup, total, int(rng.integers(2**63)))
+
+def dither_indices(lookup, total, seed):
+    """The NumPy engine's pointillism: palette indices of R+G+B sums `total`, dithered like the native kernel."""
+    main = lookup.main[total]
+    dithered = lookup.dithered[total]
+    ditherable = main != dithered
+    keep = np.ones(total.shape, dtype=bool)
+    keep[ditherable] = dither_keep(ditherable, seed)
+    return np.where(keep, main, dithered)
+
+def milk_palette(milk_type=1):
+    """The (colours, 3) palette that filter_indices indexes into."""
+    return milk_lookup(milk_type, False).palette
+
+def palette_image(indices, milk_type=1):
+    """Wraps filtered indices in a PIL 'P' image, which PNG stores at one byte per pixel or less."""
+    image = Image.fromarray(indices, 'P')
+    image.putpalette(milk_palette(milk_type).tobytes())
+    return image
+
+@functools.lru_cache(maxsize=4)
+def dither_noise(seed, height, width):
+    """Per-pixel noise shared by all the frames of a video in temporal mode."""
+    noise = np.random.default_rng([seed, height, width]).integers(2**32, size=(height, width), dtype=np.uint32)
+    noise.setflags(write=False)
+    return noise
+
+class TemporalFilter:
+    """Filters the frames of a video in order, only redoing the pixels whose brightness band changed.
+
+    Dither decisions come from fixed per-pixel noise and the pixel's band instead of a fresh draw
+    every frame, so static regions keep their pointillism pattern (no flicker, a smaller video) and
+    the output only depends on the frame and the seed, whichever frames were filtered before.
+    """
+
+    def __init__(self, milk_type=1, effect=False, seed=None):
+        self.milk_type = milk_type
+        self.effect = effect
+        self.seed = seed if seed is not None else random_seed()
+        self.previous_band = None
+        self.previous_indices = None
+
+    def filter(self, frame):
+        if self.effect and milk_native is not None:
+            lookup = milk_lookup(self.milk_type, self.effect)
+            noise = dither_noise(self.seed, *frame.shape[:2])
+            return milk_native.filter_frame_temporal(frame, lookup.main, lookup.dithered, lookup.palette, lookup.band, noise, native_threads)
+        return np.take(milk_palette(self.milk_type), self.filter_indices(frame), axis=0)
+
+    def filter_indices(self, frame):
+        """Same as filter, but returns the indices into the palette like filter_indices."""
+        if not self.effect:
+            # Without dithering the output is already a pure function of the pixels
+            return filter_indices(frame, self.milk_type)
+
+        lookup = milk_lookup(self.milk_type, self.effect)
+        if milk_native is not None:
+            # A full pass of the kernel costs less than working out which pixels changed
+            noise = dither_noise(self.seed, *frame.shape[:2])
+            return milk_native.filter_frame_temporal(frame, lookup.main, lookup.dithered, lookup.palette, lookup.band, noise, native_threads, indexed=True)
+
+        # Adding the channels one by one is several times faster than sum(axis=2)
+        total = frame[..., 0].astype(np.uint16) + frame[..., 1] + frame[..., 2]
+        band = np.take(lookup.band, total)
+        noise = dither_noise(self.seed, *band.shape)
+
+        if self.previous_band is None or self.previous_band.shape != band.shape:
+            indices = self.dither(lookup, total, band, noise)
+        else:
+            changed = band != self.previous_band
+            indices = self.previous_indices.copy()
+            indices[changed] = self.dither(lookup, total[changed], band[changed], noise[changed])
+
+        self.previous_band = band
+        self.previous_indices = indices
+        return indices
+
+    def dither(self, lookup, total, band, noise):
+        keep = noise + band.astype(np.uint32) * BAND_STEP < KEEP_THRESHOLD
+        return np.where(keep, np.take(lookup.main, total), np.take(lookup.dithered, total))
@@ -0,0 +1,193 @@
+#pragma once
+
+#include <algorithm>
+#include <cstddef>
+#include <cstdint>
+#include <thread>
+#include <vector>
+
+namespace milk {
+
+struct Band {
+    int upper;        // Upper bound (exclusive) of R + G + B
+    uint8_t main;     // Palette colour used by default
+    uint8_t dithered; // Palette colour used when the pointillism effect kicks in
+};
+
+// Same bands and palettes as milk_filter.py. Thresholds work on the channel sum so the
+// original `brightness = (R + G + B) / 3` comparisons stay exact.
+const Band BANDS_1[] = {{76, 0, 0}, {211, 0, 1}, {360, 1, 0}, {600, 1, 1}, {690, 2, 1}, {766, 2, 2}};
+const Band BANDS_2[] = {{76, 0, 0}, {211, 0, 1}, {270, 1, 0}, {450, 1, 1}, {600, 2, 1}, {766, 2, 2}};
+
+const uint8_t PALETTE_1[3][3] = {{0, 0, 0}, {102, 0, 31}, {137, 0, 146}};
+const uint8_t PALETTE_2[3][3] = {{0, 0, 0}, {92, 36, 60}, {203, 43, 43}};
+
+// Probability of keeping the main colour with the pointillism effect (0.7), scaled to 32 bits
+const uint32_t KEEP_THRESHOLD = static_cast<uint32_t>(0.7 * 4294967296.0);
+
+// Added to a pixel's noise once per band in temporal mode (golden ratio, scaled to 32 bits)
+const uint32_t BAND_STEP = 0x9E3779B9u;
+
+inline uint64_t splitmix64(uint64_t& state) {
+    uint64_t z = (state += 0x9E3779B97F4A7C15ULL);
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return z ^ (z >> 31);
+}
+
+// Palette indices and band for every possible R + G + B, plus the palette itself in output channel order
+struct Lookup {
+    uint8_t main[766];
+    uint8_t dithered[766];
+    uint16_t band[766];
+    uint8_t colours[256][3];
+};
+
+inline Lookup buildLookup(int milkType, bool bgr) {
+    const Band* bands = milkType == 1 ? BANDS_1 : BANDS_2;
+    const uint8_t (*palette)[3] = milkType == 1 ? PALETTE_1 : PALETTE_2;
+
+    Lookup lookup;
+    int band = 0;
+    for (int sum = 0; sum < 766; ++sum) {
+        while (sum >= bands[band].upper) {
+            ++band;
+        }
+        lookup.main[sum] = bands[band].main;
+        lookup.dithered[sum] = bands[band].dithered;
+        lookup.band[sum] = static_cast<uint16_t>(band);
+    }
+    for (int i = 0; i < 3; ++i) {
+        lookup.colours[i][0] = bgr ? palette[i][2] : palette[i][0];
+        lookup.colours[i][1] = palette[i][1];
+        lookup.colours[i][2] = bgr ? palette[i][0] : palette[i][2];
+    }
+    return lookup;
+}
+
+// Writes a pixel's palette colour, or just its palette index when `Indexed`
+template <bool Indexed>
+inline void writePixel(const Lookup& lookup, uint8_t colour, uint8_t* out) {
+    if (Indexed) {
+        out[0] = colour;
+    } else {
+        out[0] = lookup.colours[colour][0];
+        out[1] = lookup.colours[colour][1];
+        out[2] = lookup.colours[colour][2];
+    }
+}
+
+// Filters rows [rowBegin, rowEnd) in memory order. Every row gets its own generator derived
+// from the seed and the row number, so the output doesn't depend on the number of threads.
+template <bool Indexed>
+inline void filterRows(const Lookup& lookup, const uint8_t* src, uint8_t* dst, int width, int rowBegin, int rowEnd,
+                       size_t srcStride, size_t dstStride, int channels, bool effect, uint64_t seed) {
+    const int outChannels = Indexed ? 1 : 3;
+    for (int y = rowBegin; y < rowEnd; ++y) {
+        const uint8_t* in = src + y * srcStride;
+        uint8_t* out = dst + y * dstStride;
+        uint64_t state = seed ^ (static_cast<uint64_t>(y) * 0xD1B54A32D192ED03ULL);
+        uint64_t random = 0;
+        int randomLeft = 0;
+
+        for (int x = 0; x < width; ++x, in += channels, out += outChannels) {
+            int sum = in[0] + in[1] + in[2];
+            uint8_t colour = lookup.main[sum];
+            if (effect && colour != lookup.dithered[sum]) {
+                if (randomLeft == 0) {
+                    random = splitmix64(state);
+                    randomLeft = 2;
+                }
+                uint32_t draw = static_cast<uint32_t>(random);
+                random >>= 32;
+                --randomLeft;
+                if (draw >= KEEP_THRESHOLD) {
+                    colour = lookup.dithered[sum];
+                }
+            }
+            writePixel<Indexed>(lookup, colour, out);
+        }
+    }
+}
+
+// Temporal mode: a pixel keeps the main colour depending on fixed per-pixel `noise` and its band
+// instead of a fresh draw, so its dither decision only changes when its band does.
+template <bool Indexed>
+inline void filterRowsTemporal(const Lookup& lookup, const uint32_t* noise, const uint8_t* src, uint8_t* dst, int width, int rowBegin, int rowEnd,
+                               size_t srcStride, size_t dstStride, int channels) {
+    const int outChannels = Indexed ? 1 : 3;
+    for (int y = rowBegin; y < rowEnd; ++y) {
+        const uint8_t* in = src + y * srcStride;
+        const uint32_t* rowNoise = noise + static_cast<size_t>(y) * width;
+        uint8_t* out = dst + y * dstStride;
+
+        for (int x = 0; x < width; ++x, in += channels, out += outChannels) {
+            int sum = in[0] + in[1] + in[2];
+            uint32_t draw = rowNoise[x] + static_cast<uint32_t>(lookup.band[sum]) * BAND_STEP;
+            uint8_t colour = draw < KEEP_THRESHOLD ? lookup.main[sum] : lookup.dithered[sum];
+            writePixel<Indexed>(lookup, colour, out);
+        }
+    }
+}
+
+// Runs `rows(rowBegin, rowEnd)` over the frame, splitting its rows between `numThreads` threads (0 uses every core)
+template <typename RowFunction>
+inline void forEachRowRange(int height, int numThreads, RowFunction rows) {
+    if (numThreads <= 0) {
+        numThreads = std::max(1u, std::thread::hardware_concurrency());
+    }
+    numThreads = std::min(numThreads, height);
+
+    if (numThreads <= 1) {
+        rows(0, height);
+        return;
+    }
+
+    std::vector<std::thread> threads;
+    int rowsPerThread = (height + numThreads - 1) / numThreads;
+    for (int i = 0; i < numThreads; ++i) {
+        int rowBegin = i * rowsPerThread;
+        int rowEnd = std::min(height, rowBegin + rowsPerThread);
+        if (rowBegin >= rowEnd) {
+            break;
+        }
+        threads.emplace_back(rows, rowBegin, rowEnd);
+    }
+    for (auto& t : threads) {
+        t.join();
+    }
+}
+
+// Applies the milk filter to a whole frame on `numThreads` threads. `src` has `channels` >= 3
+// bytes per pixel, `dst` gets 3 (the palette colour), or 1 (the palette index) when `indexed`.
+inline void filterFrame(const Lookup& lookup, const uint8_t* src, uint8_t* dst, int width, int height, size_t srcStride, size_t dstStride,
+                        int channels, bool effect, uint64_t seed, int numThreads, bool indexed = false) {
+    forEachRowRange(height, numThreads, [&](int rowBegin, int rowEnd) {
+        if (indexed) {
+            filterRows<true>(lookup, src, dst, width, rowBegin, rowEnd, srcStride, dstStride, channels, effect, seed);
+        } else {
+            filterRows<false>(lookup, src, dst, width, rowBegin, rowEnd, srcStride, dstStride, channels, effect, seed);
+        }
+    });
+}
+
+// Same as above in temporal mode, `noise` holds one value per pixel
+inline void filterFrameTemporal(const Lookup& lookup, const uint32_t* noise, const uint8_t* src, uint8_t* dst, int width, int height,
+                                size_t srcStride, size_t dstStride, int channels, int numThreads, bool indexed = false) {
+    forEachRowRange(height, numThreads, [&](int rowBegin, int rowEnd) {
+        if (indexed) {
+            filterRowsTemporal<true>(lookup, noise, src, dst, width, rowBegin, rowEnd, srcStride, dstStride, channels);
+        } else {
+            filterRowsTemporal<false>(lookup, noise, src, dst, width, rowBegin, rowEnd, srcStride, dstStride, channels);
+        }
+    });
+}
+
+// Same as above with one of the built-in milk types
+inline void filterFrame(const uint8_t* src, uint8_t* dst, int width, int height, size_t srcStride, size_t dstStride,
+                        int channels, int milkType, bool effect, bool bgr, uint64_t seed, int numThreads) {
+    Lookup lookup = buildLookup(milkType, bgr);
+    filterFrame(lookup, src, dst, width, height, srcStride, dstStride, channels, effect, seed, numThreads);
+}
+
+} // namespace milk
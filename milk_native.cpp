@@ -0,0 +1,115 @@
+#include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+#include <cstring>
+#include <stdexcept>
+#include "milk_kernel.hpp"
+
+namespace py = pybind11;
+
+using ByteArray = py::array_t<uint8_t, py::array::c_style | py::array::forcecast>;
+
+using NoiseArray = py::array_t<uint32_t, py::array::c_style | py::array::forcecast>;
+using BandArray = py::array_t<uint16_t, py::array::c_style | py::array::forcecast>;
+
+// Builds the kernel lookup from the tables of milk_filter.milk_lookup, so palettes added from Python work here too
+milk::Lookup makeLookup(ByteArray main, ByteArray dithered, ByteArray palette) {
+    if (main.ndim() != 1 || main.shape(0) != 766 || dithered.ndim() != 1 || dithered.shape(0) != 766) {
+        throw std::invalid_argument("main and dithered must have one entry per R+G+B sum (766)");
+    }
+    if (palette.ndim() != 2 || palette.shape(1) != 3 || palette.shape(0) < 1 || palette.shape(0) > 256) {
+        throw std::invalid_argument("palette must be a (colours, 3) array with 1 to 256 colours");
+    }
+
+    milk::Lookup lookup;
+    int colours = static_cast<int>(palette.shape(0));
+    for (int sum = 0; sum < 766; ++sum) {
+        if (main.at(sum) >= colours || dithered.at(sum) >= colours) {
+            throw std::invalid_argument("lookup tables must only hold indices into the palette");
+        }
+    }
+    std::memcpy(lookup.main, main.data(), 766);
+    std::memcpy(lookup.dithered, dithered.data(), 766);
+    std::memset(lookup.colours, 0, sizeof(lookup.colours));
+    std::memcpy(lookup.colours, palette.data(), colours * 3);
+    std::memset(lookup.band, 0, sizeof(lookup.band));
+    return lookup;
+}
+
+py::buffer_info frameInfo(ByteArray& frame) {
+    py::buffer_info info = frame.request();
+    if (info.ndim != 3 || info.shape[2] < 3) {
+        throw std::invalid_argument("frame must be a (height, width, 3) uint8 array");
+    }
+    return info;
+}
+
+// The filtered frame: (height, width, 3) colours, or (height, width) palette indices
+py::array_t<uint8_t> outputFrame(int height, int width, bool indexed) {
+    if (indexed) {
+        return py::array_t<uint8_t>({height, width});
+    }
+    return py::array_t<uint8_t>({height, width, 3});
+}
+
+py::array_t<uint8_t> filterFrame(ByteArray frame, ByteArray main, ByteArray dithered, ByteArray palette, bool effect, uint64_t seed, int threads, bool indexed) {
+    py::buffer_info info = frameInfo(frame);
+    milk::Lookup lookup = makeLookup(main, dithered, palette);
+
+    int height = static_cast<int>(info.shape[0]);
+    int width = static_cast<int>(info.shape[1]);
+    int channels = static_cast<int>(info.shape[2]);
+    size_t outChannels = indexed ? 1 : 3;
+
+    py::array_t<uint8_t> filtered = outputFrame(height, width, indexed);
+    const uint8_t* src = static_cast<const uint8_t*>(info.ptr);
+    uint8_t* dst = filtered.mutable_data();
+
+    {
+        // The kernel only touches the two buffers, let other Python threads (the GUI) run meanwhile
+        py::gil_scoped_release release;
+        milk::filterFrame(lookup, src, dst, width, height, static_cast<size_t>(width) * channels, width * outChannels,
+                          channels, effect, seed, threads, indexed);
+    }
+
+    return filtered;
+}
+
+py::array_t<uint8_t> filterFrameTemporal(ByteArray frame, ByteArray main, ByteArray dithered, ByteArray palette, BandArray band, NoiseArray noise, int threads, bool indexed) {
+    py::buffer_info info = frameInfo(frame);
+    milk::Lookup lookup = makeLookup(main, dithered, palette);
+
+    int height = static_cast<int>(info.shape[0]);
+    int width = static_cast<int>(info.shape[1]);
+    int channels = static_cast<int>(info.shape[2]);
+    if (band.ndim() != 1 || band.shape(0) != 766) {
+        throw std::invalid_argument("band must have one entry per R+G+B sum (766)");
+    }
+    if (noise.ndim() != 2 || noise.shape(0) != height || noise.shape(1) != width) {
+        throw std::invalid_argument("noise must be a (height, width) uint32 array");
+    }
+    std::memcpy(lookup.band, band.data(), sizeof(lookup.band));
+    size_t outChannels = indexed ? 1 : 3;
+
+    py::array_t<uint8_t> filtered = outputFrame(height, width, indexed);
+    const uint8_t* src = static_cast<const uint8_t*>(info.ptr);
+    const uint32_t* noiseData = noise.data();
+    uint8_t* dst = filtered.mutable_data();
+
+    {
+        py::gil_scoped_release release;
+        milk::filterFrameTemporal(lookup, noiseData, src, dst, width, height, static_cast<size_t>(width) * channels, width * outChannels,
+                                  channels, threads, indexed);
+    }
+
+    return filtered;
+}
+
+PYBIND11_MODULE(milk_native, m) {
+    m.doc() = "Native row-major, multi-threaded milk filter kernel";
+    m.def("filter_frame", &filterFrame, "Maps a (height, width, 3) RGB array onto a palette through R+G+B lookup tables (palette indices only when indexed).",
+          py::arg("frame"), py::arg("main"), py::arg("dithered"), py::arg("palette"), py::arg("effect") = false, py::arg("seed") = 0, py::arg("threads") = 0,
+          py::arg("indexed") = false);
+    m.def("filter_frame_temporal", &filterFrameTemporal, "Same as filter_frame with pointillism, dithering from fixed per-pixel noise and the pixel's band.",
+          py::arg("frame"), py::arg("main"), py::arg("dithered"), py::arg("palette"), py::arg("band"), py::arg("noise"), py::arg("threads") = 0,
+          py::arg("indexed") = false);
+}
@@ -0,0 +1,791 @@
+import os
+import atexit
+import itertools
+import math
+import queue
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+from PIL import Image
+from multiprocessing import Process, Queue, cpu_count, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from milk_cache import DEFAULT_CACHE_SIZE, get_frame_cache
+from milk_filter import TemporalFilter, compress_array, filter_array, filter_indices, frame_rng, milk_palette, random_seed, set_native_threads
+from milk_encoder import encoder_args, remux_args
+from milk_probe import probe_video
+from milk_profile import flush_profile, profile_setting, stage
+from milk_progress import JobCancelled, ProgressTracker, checkpoint_processes, ffmpeg_error, resume_processes, run_ffmpeg_with_progress, suspend_processes
+
+DEFAULT_CHUNK_SIZE = 8
+
+# Shortest segment segment_video splits a video into, shorter ones cost more in ffmpeg start-up than they save
+MIN_SEGMENT_SECONDS = 2
+
+# How every frame of a conversion is filtered, what a pool task needs besides the frame itself
+FilterSettings = namedtuple('FilterSettings', ['compression', 'effect', 'milk_type', 'quality', 'seed', 'cache_dir', 'cache_size', 'temporal'],
+                            defaults=(False, False, 1, 90, None, None, DEFAULT_CACHE_SIZE, False))
+
+# What a pool worker needs to convert one segment of a video, see segment_video
+SegmentTask = namedtuple('SegmentTask', ['video_path', 'path', 'fps', 'width', 'height', 'start', 'first_frame', 'end_frame', 'index'])
+
+_frame_pool = None
+
+# What a pool worker keeps between tasks, per thread so executors running tasks on threads work too
+_worker_state = threading.local()
+
+@contextmanager
+def job_scratch(scratch_root=None):
+    """Creates a private scratch folder for one conversion and always removes it afterwards.
+
+    `scratch_root` defaults to the system temp folder (TMPDIR), point it at a tmpfs such as
+    /dev/shm for the fastest frame I/O.
+    """
+    if scratch_root:
+        os.makedirs(scratch_root, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='milk-', dir=scratch_root)
+    try:
+        yield scratch
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def open_decoder(video_path, fps, start=None, frames=None, log=None):
+    """Starts an ffmpeg process that writes the video's frames to stdout as raw rgb24.
+
+    `frames` limits it to the (first, end) frame numbers of the whole video at `fps`, end excluded and
+    None for all the rest, decoding from `start` seconds on. The frames keep the timestamps of the whole
+    video, so the fps filter samples them the same as without a range, wherever `start` falls.
+    """
+    command = ['ffmpeg']
+    video_filter = f'fps={fps}'
+    if frames is not None:
+        first, end = frames
+        # After the fps filter, a frame's timestamp is its frame number counted from 0
+        command += ['-copyts', '-start_at_zero']
+        video_filter += f',trim=start_pts={first - 1}'
+        if end is not None:
+            # Decoding one frame more, the fps filter only knows when to stop showing a frame by the one after it
+            command += ['-to', str(end / fps)]
+            video_filter += f':end_pts={end - 1}'
+    if start:
+        command += ['-ss', str(start)]
+    command += [
+        '-i', video_path,
+        '-vf', video_filter,
+        '-f', 'rawvideo',
+        '-pix_fmt', 'rgb24',
+        '-'
+    ]
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log or subprocess.DEVNULL)
+
+def ffmpeg_palette(palette):
+    """Packs a (colours, 3) palette the way ffmpeg's pal8 expects it after every frame: 256 native-endian ARGB words."""
+    colours = palette.astype(np.uint32)
+    entries = np.zeros(256, dtype=np.uint32)
+    entries[:len(palette)] = 0xFF000000 | colours[:, 0] << 16 | colours[:, 1] << 8 | colours[:, 2]
+    return entries.tobytes()
+
+def open_encoder(output_path, fps, width, height, original_video_path, encoder=None, log=None, pix_fmt='rgb24'):
+    """Starts an ffmpeg process that encodes raw frames from stdin with an encoder profile, keeping the original audio.
+
+    Frames are rgb24, or pal8 palette indices each followed by its ffmpeg_palette. Without an
+    `original_video_path` only the video is written.
+    """
+    command = [
+        'ffmpeg',
+        '-y',
+        '-f', 'rawvideo',
+        '-pix_fmt', pix_fmt,
+        '-s', f'{width}x{height}',
+        '-r', str(fps),
+        '-i', '-',
+    ]
+    if original_video_path is not None:
+        command += ['-i', original_video_path, '-map', '0:v', '-map', '1:a?', *encoder_args(encoder), '-shortest']
+    else:
+        command += ['-map', '0:v', *encoder_args(encoder)]
+    command.append(output_path)
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log or subprocess.DEVNULL)
+
+def read_frames(decoder, width, height):
+    """Yields frames from a decoder's stdout as (height, width, 3) arrays."""
+    frame_size = width * height * 3
+    while True:
+        # Mostly waiting for ffmpeg to decode the frame
+        with stage('decode'):
+            data = decoder.stdout.read(frame_size)
+        if len(data) < frame_size:
+            break
+        yield np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+
+def shared_settings(settings, make_seed=random_seed):
+    """`settings` (FilterSettings or ConvertOptions) with the seed all their workers dither from.
+
+    In temporal mode every frame has to use the same noise, so a seed is made up if none was given.
+    """
+    if settings.temporal and settings.seed is None:
+        return settings._replace(seed=make_seed())
+    return settings
+
+def settings_cache(settings):
+    """The FrameCache frames are filtered through, None without a cache_dir."""
+    return get_frame_cache(settings.cache_dir, settings.cache_size) if settings.cache_dir else None
+
+def settings_temporal_filter(settings):
+    """A TemporalFilter in temporal mode, None otherwise."""
+    return TemporalFilter(settings.milk_type, settings.effect, settings.seed) if settings.temporal else None
+
+def filter_frame_indices(frame, frame_num, settings, cache=None, temporal_filter=None):
+    """Filters one decoded frame into palette indices, through the FrameCache and TemporalFilter when given."""
+    if cache is not None:
+        with stage('filter', frame=frame_num, cache=True):
+            return cache.filter(frame, settings.compression, settings.effect, settings.milk_type, settings.quality, settings.seed,
+                                frame_num, temporal_filter, indexed=True)
+    if settings.compression:
+        with stage('compress', frame=frame_num):
+            frame = compress_array(frame, settings.quality)
+    with stage('filter', frame=frame_num):
+        if temporal_filter is not None:
+            return temporal_filter.filter_indices(frame)
+        return filter_indices(frame, settings.milk_type, settings.effect, frame_rng(settings.seed, frame_num))
+
+class FrameRing:
+    """Frame slots in shared memory, so frames cross processes without being pickled or copied.
+
+    Each slot holds a decoded rgb24 frame followed by the palette indices it's filtered into:
+    the decoder reads straight into a slot, a pool worker filters it in place and the encoder
+    writes the indices out, only slot numbers go through the queues.
+    """
+
+    def __init__(self, slots, width, height, name=None):
+        self.slots = slots
+        self.width = width
+        self.height = height
+        self.frame_size = width * height * 3
+        self.slot_size = self.frame_size + width * height
+        self.owner = name is None
+        if self.owner:
+            self.memory = SharedMemory(create=True, size=slots * self.slot_size)
+        else:
+            self.memory = SharedMemory(name=name)
+
+    @property
+    def spec(self):
+        """What another process needs to attach to the ring."""
+        return self.slots, self.width, self.height, self.memory.name
+
+    def frame(self, slot):
+        return np.ndarray((self.height, self.width, 3), np.uint8, self.memory.buf, slot * self.slot_size)
+
+    def indices(self, slot):
+        return np.ndarray((self.height, self.width), np.uint8, self.memory.buf, slot * self.slot_size + self.frame_size)
+
+    def indices_buffer(self, slot):
+        """The slot's indices as a memoryview, to release once written out so the ring can close."""
+        start = slot * self.slot_size + self.frame_size
+        return self.memory.buf[start:start + self.width * self.height]
+
+    def read_frame(self, stream, slot):
+        """Reads the next rgb24 frame of `stream` into a slot, returns False at the end of the stream."""
+        start = slot * self.slot_size
+        with stage('decode'), self.memory.buf[start:start + self.frame_size] as view:
+            filled = 0
+            while filled < self.frame_size:
+                count = stream.readinto(view[filled:])
+                if not count:
+                    return False
+                filled += count
+        return True
+
+    def close(self):
+        if self.owner:
+            self.memory.unlink()
+        try:
+            self.memory.close()
+        except BufferError:
+            pass  # A feeder thread on its way out still reads into a slot, the mapping goes with it
+
+def attach_ring(spec):
+    """Attaches a pool worker to a FrameRing, keeping the attachment until the next ring comes along."""
+    slots, width, height, name = spec
+    ring = getattr(_worker_state, 'ring', None)
+    if ring is None or ring.memory.name != name:
+        if ring is not None:
+            ring.close()
+        ring = _worker_state.ring = FrameRing(slots, width, height, name)
+    return ring
+
+def worker_temporal_filter(settings):
+    """Like settings_temporal_filter, but one per worker and video: its output doesn't depend on which frames it saw."""
+    if not settings.temporal:
+        return None
+    key = (settings.milk_type, settings.effect, settings.seed)
+    if getattr(_worker_state, 'temporal_key', None) != key:
+        _worker_state.temporal_filter = settings_temporal_filter(settings)
+        _worker_state.temporal_key = key
+    return _worker_state.temporal_filter
+
+def _filter_slot(ring_spec, slot, frame_num, settings):
+    """Pool task: filters the frame in a FrameRing slot into the slot's palette indices."""
+    ring = attach_ring(ring_spec)
+    ring.indices(slot)[...] = filter_frame_indices(ring.frame(slot), frame_num, settings, settings_cache(settings), worker_temporal_filter(settings))
+    return frame_num, slot
+
+def filter_stream(decoder, width, height, settings, first_frame=1):
+    """Yields (frame number, palette indices) for every frame of a decoder, filtered in this process with FilterSettings."""
+    cache = settings_cache(settings)
+    temporal_filter = settings_temporal_filter(settings)
+    for frame_num, frame in enumerate(read_frames(decoder, width, height), start=first_frame):
+        yield frame_num, filter_frame_indices(frame, frame_num, settings, cache, temporal_filter)
+
+def filter_stream_pooled(decoder, width, height, settings, pool, control):
+    """Same as filter_stream on a FramePool's (or ExecutorPool's) workers, frames travel through a FrameRing and come out in order."""
+    # Enough slots for every worker to have a frame in hand and one queued, plus the one being written out
+    ring = FrameRing(pool.workers * 2 + 1, width, height)
+    free_slots = queue.Queue()
+    for slot in range(ring.slots):
+        free_slots.put(slot)
+    stopped = threading.Event()
+
+    def fill():
+        for frame_num in itertools.count(1):
+            slot = free_slots.get()
+            if stopped.is_set() or not ring.read_frame(decoder.stdout, slot):
+                return
+            yield ring.spec, slot, frame_num, settings
+
+    filtered = {}
+    next_frame = 1
+    try:
+        for frame_num, slot in pool.imap(_filter_slot, fill(), control):
+            filtered[frame_num] = slot
+            while next_frame in filtered:
+                slot = filtered.pop(next_frame)
+                with ring.indices_buffer(slot) as indices:
+                    yield next_frame, indices
+                free_slots.put(slot)
+                next_frame += 1
+    finally:
+        stopped.set()
+        free_slots.put(None)  # Unblocks the feeder if it's waiting for a slot
+        ring.close()
+
+def pipe_stream(decoder, decoder_log, encoder, encoder_log, frames, palette, output_path, tracker, control=None):
+    """Writes the (frame number, palette indices) pairs of `frames` to an encoder as pal8 and waits for both ffmpeg processes.
+
+    `decoder` is None when the frames don't come from ffmpeg. Returns the number of frames written,
+    raises RuntimeError with the end of the log of the ffmpeg process that failed. Whatever stops it
+    early (a cancel, a failing worker, decoder or encoder) also removes the output, rather than leave a truncated video.
+    """
+    processes = [process for process in (decoder, encoder) if process is not None]
+    frames_written = 0
+    try:
+        for frame_num, indices in frames:
+            checkpoint_processes(control, processes)
+            try:
+                # Mostly waiting for ffmpeg to encode the frames before
+                with stage('encode', frame=frame_num):
+                    encoder.stdin.write(indices)
+                    encoder.stdin.write(palette)
+            except BrokenPipeError:
+                break  # The encoder quit, its exit code and log tell why
+            frames_written += 1
+            tracker.update(frames_written)
+    except BaseException:
+        # Killed before its stdin closes, or ffmpeg would finish a playable video of the frames so far
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        encoder.wait()
+        remove_output(output_path)
+        raise
+    finally:
+        frames.close()
+        if decoder is not None:
+            decoder.stdout.close()
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+        for process in processes:
+            process.wait()
+
+    if encoder.returncode != 0:
+        remove_output(output_path)
+        raise ffmpeg_error(encoder.returncode, encoder_log)
+    if decoder is not None and decoder.returncode != 0:
+        # Its frames just stop, like at the end of the video
+        remove_output(output_path)
+        raise ffmpeg_error(decoder.returncode, decoder_log)
+    return frames_written
+
+def remove_output(output_path):
+    """Deletes what a failed conversion wrote so far."""
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+def stream_video(video_path, output_path, fps, compression=False, effect=False, milk_type=1, quality=90, seed=None, progress_callback=None, control=None, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, temporal=False, encoder=None, workers=None, pool=None):
+    """Filters a video by piping raw frames from an ffmpeg decoder straight into an ffmpeg encoder.
+
+    Filtered frames travel as one palette index per pixel (a third of rgb24), ffmpeg turns them
+    into the encoder's pixel format. With more than one worker (one per CPU by default) the frame
+    pool filters them through a FrameRing, otherwise this process does. A `pool` given is always used.
+    """
+    info = probe_video(video_path)
+    width, height = info.width, info.height
+    palette = ffmpeg_palette(milk_palette(milk_type))
+    workers = workers or cpu_count()
+    # Before starting ffmpeg: workers forked later would inherit the encoder's stdin and it would never see the end
+    if pool is None and workers > 1:
+        pool = get_frame_pool(workers)
+    settings = shared_settings(FilterSettings(compression, effect, milk_type, quality, seed, cache_dir, cache_size, temporal))
+    tracker = ProgressTracker('stream', int(info.duration * fps), progress_callback)
+
+    # The logs are kept to explain a failure
+    with tempfile.TemporaryFile() as decoder_log, tempfile.TemporaryFile() as encoder_log:
+        decoder = open_decoder(video_path, fps, log=decoder_log)
+        # Without an audio stream there's no need to open the original a second time
+        audio_source = video_path if info.has_audio is not False else None
+        encoder = open_encoder(output_path, fps, width, height, audio_source, encoder, encoder_log, pix_fmt='pal8')
+
+        if pool is not None:
+            frames = filter_stream_pooled(decoder, width, height, settings, pool, control)
+        else:
+            frames = filter_stream(decoder, width, height, settings)
+
+        frames_written = pipe_stream(decoder, decoder_log, encoder, encoder_log, frames, palette, output_path, tracker, control)
+
+    tracker.finish(frames_written)
+
+def keyframe_times(video_path):
+    """Lists the timestamps in seconds of the video's keyframes, decoding only those."""
+    command = ['ffmpeg', '-skip_frame', 'nokey', '-i', video_path, '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-']
+    log = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace').stderr
+    return sorted(float(time) for time in re.findall(r'pts_time:\s*(-?[\d.]+)', log))
+
+def split_at_keyframes(keyframes, duration, count, min_length=MIN_SEGMENT_SECONDS):
+    """Picks up to `count` (start, end) ranges of about the same length, each starting at a keyframe.
+
+    The last range ends at None, the end of the video. Seeking to a keyframe is exact and fast,
+    open_decoder's frame range then picks the segment's frames out of the whole video's.
+    """
+    starts = [0]
+    for i in range(1, count):
+        target = duration * i / count
+        candidates = [time for time in keyframes if time - starts[-1] >= min_length and duration - time >= min_length]
+        if not candidates:
+            break
+        start = min(candidates, key=lambda time: abs(time - target))
+        if start > starts[-1]:
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [None]))
+
+def _convert_segment(segment, settings, encoder, progress_name):
+    """Pool task: decodes, filters and encodes the frames of a SegmentTask into a video-only segment."""
+    progress = SharedMemory(name=progress_name)
+    try:
+        # Frames done are reported through shared memory, the parent adds them up
+        tracker = ProgressTracker('segment', 0, lambda event: struct.pack_into('q', progress.buf, segment.index * 8, event['frames_done']))
+        with stage('segment', index=segment.index), tempfile.TemporaryFile() as decoder_log, tempfile.TemporaryFile() as encoder_log:
+            decoder = open_decoder(segment.video_path, segment.fps, segment.start, (segment.first_frame, segment.end_frame), decoder_log)
+            encoder_process = open_encoder(segment.path, segment.fps, segment.width, segment.height, None, encoder, encoder_log, pix_fmt='pal8')
+            frames = filter_stream(decoder, segment.width, segment.height, settings, segment.first_frame)
+            palette = ffmpeg_palette(milk_palette(settings.milk_type))
+            frames_written = pipe_stream(decoder, decoder_log, encoder_process, encoder_log, frames, palette, segment.path, tracker)
+        tracker.finish(frames_written)
+        return frames_written
+    finally:
+        progress.close()
+
+def concat_segments(segment_paths, output_path, original_video_path, encoder=None, control=None):
+    """Joins video-only segments without encoding them again, muxing in the original audio once."""
+    list_path = os.path.join(os.path.dirname(segment_paths[0]), 'segments.txt')
+    with open(list_path, 'w') as f:
+        for segment_path in segment_paths:
+            f.write(f"file '{os.path.basename(segment_path)}'\n")
+    command = [
+        'ffmpeg',
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', list_path,
+        '-i', original_video_path,
+        '-map', '0:v',
+        '-map', '1:a?',
+        *remux_args(encoder),
+        '-shortest',
+        output_path
+    ]
+    try:
+        run_ffmpeg_with_progress(command, ProgressTracker('concat', 0), control)
+    except BaseException:
+        remove_output(output_path)
+        raise
+
+def segment_video(video_path, output_path, fps, compression=False, effect=False, milk_type=1, quality=90, seed=None, progress_callback=None, control=None, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, temporal=False, encoder=None, workers=None, segments=None, scratch_root=None, pool=None):
+    """Converts a video in segments split at keyframes, each one decoded, filtered and encoded by its own pool worker.
+
+    Unlike stream_video, the decoding and the encoding run in parallel too. `segments` defaults to
+    the number of workers, the segments are joined without encoding them again.
+    """
+    info = probe_video(video_path)
+    width, height, duration = info.width, info.height, info.duration
+    pool = pool or get_frame_pool(workers)
+    settings = shared_settings(FilterSettings(compression, effect, milk_type, quality, seed, cache_dir, cache_size, temporal))
+    ranges = split_at_keyframes(keyframe_times(video_path), duration, segments or pool.workers)
+    tracker = ProgressTracker('segments', int(duration * fps), progress_callback)
+
+    progress = SharedMemory(create=True, size=8 * len(ranges))
+    stopped = threading.Event()
+
+    def report():
+        while not stopped.wait(0.5):
+            tracker.update(sum(struct.unpack_from(f'{len(ranges)}q', progress.buf)), pool.queue_depth())
+
+    reporter = threading.Thread(target=report, daemon=True)
+    try:
+        with job_scratch(scratch_root) as scratch:
+            # Each segment starts at the first frame on the output's frame grid at or after its keyframe, so the
+            # segments hold the frames of stream_video and their frame numbers carry on, for the same seeded pointillism
+            first_frames = [math.ceil(start * fps) + 1 for start, _ in ranges]
+            tasks = []
+            for index, ((start, _), first_frame, end_frame) in enumerate(zip(ranges, first_frames, first_frames[1:] + [None])):
+                segment_path = os.path.join(scratch, f'segment{index:04d}.mkv')
+                segment = SegmentTask(video_path, segment_path, fps, width, height, start, first_frame, end_frame, index)
+                tasks.append((segment, settings, encoder, progress.name))
+
+            reporter.start()
+            frames_done = sum(pool.imap(_convert_segment, tasks, control))
+            stopped.set()
+            reporter.join()
+            tracker.update(frames_done)
+            concat_segments([segment.path for segment, *_ in tasks], output_path, video_path, encoder, control)
+    finally:
+        stopped.set()
+        if reporter.is_alive():
+            reporter.join()
+        progress.close()
+        progress.unlink()
+    tracker.finish(frames_done)
+
+def grab_frame(video_path, timestamp, width, height):
+    """Decodes the frame at `timestamp` seconds, scaled to width x height, as an RGB array."""
+    command = [
+        'ffmpeg',
+        '-ss', f'{timestamp:.3f}',
+        '-i', video_path,
+        '-frames:v', '1',
+        '-vf', f'scale={width}:{height}',
+        '-f', 'rawvideo',
+        '-pix_fmt', 'rgb24',
+        '-'
+    ]
+    data = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    if len(data) < width * height * 3:
+        return None
+    return np.frombuffer(data[:width * height * 3], dtype=np.uint8).reshape(height, width, 3)
+
+def preview_video(video_path, count=4, max_width=480, compression=False, effect=False, milk_type=1, quality=90, seed=None):
+    """Filters a few downscaled frames spread over the video, returning (timestamp, original, filtered) tuples."""
+    info = probe_video(video_path)
+    width = min(max_width, info.width)
+    height = max(2, round(info.height * width / info.width / 2) * 2)
+    timestamps = [info.duration * (i + 0.5) / count for i in range(count)]
+
+    # Each seek is its own short ffmpeg run, so they can all decode at once
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        frames = list(executor.map(lambda timestamp: grab_frame(video_path, timestamp, width, height), timestamps))
+
+    previews = []
+    for frame_num, (timestamp, frame) in enumerate(zip(timestamps, frames)):
+        if frame is None:
+            continue
+        original = frame
+        if compression:
+            frame = compress_array(frame, quality)
+        previews.append((timestamp, original, filter_array(frame, milk_type, effect, frame_rng(seed, frame_num))))
+    return previews
+
+def preview_sheet(previews):
+    """Lays out previews as an image with the original frames on the left and the filtered ones on the right."""
+    if not previews:
+        return None
+    height, width = previews[0][1].shape[:2]
+    sheet = Image.new('RGB', (width * 2, height * len(previews)))
+    for row, (timestamp, original, filtered) in enumerate(previews):
+        sheet.paste(Image.fromarray(original), (0, row * height))
+        sheet.paste(Image.fromarray(filtered), (width, row * height))
+    return sheet
+
+def _pool_worker(tasks, results):
+    """Runs tasks from the pool's queue until it receives the stop sentinel."""
+    # The pool already keeps every core busy, more threads per frame would only oversubscribe them
+    set_native_threads(1)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job, function, args = task
+        try:
+            results.put((job, _run_task(function, args), None))
+        except Exception:
+            results.put((job, None, traceback.format_exc()))
+
+def _run_task(function, args):
+    """Runs a pool task, writing out what it recorded when the run is profiled."""
+    try:
+        return function(*args)
+    finally:
+        flush_profile()
+
+class TaskFeeder:
+    """Hands the args tuples of a pool's `chunks` to `submit` on a daemon thread, as the pool makes room.
+
+    `submit(args)` returns False when there was no room after a short wait, the feeder then tries
+    again unless stopped or cancelled. While `control` is paused no new chunks are handed out.
+    """
+
+    def __init__(self, chunks, submit, control=None):
+        self.chunks = chunks
+        self.submit = submit
+        self.control = control
+        self.submitted = 0
+        self.errors = []
+        self.stopped = threading.Event()
+        self.fed = threading.Event()
+        self.thread = threading.Thread(target=self.feed, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def feed(self):
+        try:
+            for args in self.chunks:
+                while True:
+                    if self.stopped.is_set():
+                        return
+                    if self.control is not None:
+                        try:
+                            self.control.checkpoint()
+                        except JobCancelled:
+                            return
+                    if self.submit(args):
+                        break
+                self.submitted += 1
+        except Exception as error:
+            self.errors.append(error)
+        finally:
+            self.fed.set()
+
+    def pending(self, received):
+        """Whether results are still to come once `received` have, raising what stopped the feeder."""
+        if self.errors:
+            raise self.errors[0]
+        # Once everything is fed `submitted` is final
+        return not self.fed.is_set() or received < self.submitted
+
+    def finish(self):
+        self.thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def stop(self):
+        """Stops feeding, the caller no longer reads the results."""
+        self.stopped.set()
+
+class FramePool:
+    """Persistent worker processes that pull small chunks of frames from a bounded queue."""
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = workers or cpu_count()
+        self.profile = profile_setting()
+        self.tasks = Queue(maxsize=queue_size or self.workers * 2)
+        self.results = Queue()
+        self.job = 0
+        # Workers share this process's tracker, which knows a FrameRing they attach to is unlinked here
+        resource_tracker.ensure_running()
+        self.processes = [Process(target=_pool_worker, args=(self.tasks, self.results), daemon=True) for _ in range(self.workers)]
+        for process in self.processes:
+            process.start()
+
+    def is_alive(self):
+        return all(process.is_alive() for process in self.processes)
+
+    def queue_depth(self):
+        """Chunks waiting in the queue, or None where the platform can't tell (macOS)."""
+        try:
+            return self.tasks.qsize()
+        except NotImplementedError:
+            return None
+
+    def imap(self, function, chunks, control=None):
+        """Runs `function(*args)` for every args tuple in `chunks`, yielding results as they complete.
+
+        While `control` is paused no new chunks are handed out, cancelling it kills the workers
+        right away (the next job gets a fresh pool). `chunks` can be a generator, it's consumed
+        on a feeder thread as the queue makes room, and no longer once the caller stops reading.
+        """
+        self.job += 1
+        job = self.job
+
+        def submit(args):
+            try:
+                self.tasks.put((job, function, args), timeout=0.5)
+                return True
+            except queue.Full:
+                return False
+
+        feeder = TaskFeeder(chunks, submit, control)
+        feeder.start()
+        received = 0
+        try:
+            while feeder.pending(received):
+                if control is not None and control.is_paused():
+                    # Freeze the workers mid-frame too, where the platform allows it
+                    suspend_processes(self.processes)
+                    control.running.wait()
+                    resume_processes(self.processes)
+                if control is not None and control.cancelled.is_set():
+                    self.terminate()
+                    raise JobCancelled()
+                try:
+                    result_job, result, error = self.results.get(timeout=0.2)
+                except queue.Empty:
+                    if not self.is_alive():
+                        raise RuntimeError("A filter worker died unexpectedly")
+                    continue
+                if result_job != job:
+                    continue
+                if error:
+                    raise RuntimeError(f"Filter worker failed:\n{error}")
+                received += 1
+                yield result
+            feeder.finish()
+        finally:
+            # Chunks already queued still run, their results are told apart by the job number
+            feeder.stop()
+
+    def terminate(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def close(self):
+        for _ in self.processes:
+            while True:
+                # A worker dying now (a signal to the whole process group) would leave the queue full for good
+                if not self.is_alive():
+                    self.terminate()
+                    return
+                try:
+                    self.tasks.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+        for process in self.processes:
+            process.join()
+
+class ExecutorPool:
+    """FramePool's interface over a concurrent.futures executor, for filtering on threads or processes managed elsewhere."""
+
+    def __init__(self, executor, workers=None):
+        self.executor = executor
+        self.workers = workers or getattr(executor, '_max_workers', None) or cpu_count()
+        self.jobs = []
+        if isinstance(executor, ProcessPoolExecutor):
+            # Like FramePool's: workers share this process's tracker, and they start now rather than
+            # after an encoder, whose stdin they would inherit (forked executors start them all at once)
+            resource_tracker.ensure_running()
+            executor.submit(os.getpid).result()
+
+    def queue_depth(self):
+        """Tasks handed to the executor that haven't finished."""
+        return sum(len(pending) for pending in self.jobs)
+
+    def imap(self, function, chunks, control=None):
+        """Runs `function(*args)` for every args tuple in `chunks`, yielding results as they complete.
+
+        At most two tasks per worker are handed out at a time, none while `control` is paused.
+        Cancelling it cancels the tasks not started yet, the running ones are left to finish.
+        """
+        results = queue.Queue()
+        pending = set()
+        free = threading.Semaphore(self.workers * 2)
+
+        def done(future):
+            pending.discard(future)
+            free.release()
+            results.put(future)
+
+        def submit(args):
+            if not free.acquire(timeout=0.5):
+                return False
+            if feeder.stopped.is_set():
+                # Stopped while waiting for room
+                free.release()
+                return False
+            future = self.executor.submit(_run_task, function, args)
+            pending.add(future)
+            future.add_done_callback(done)
+            return True
+
+        self.jobs.append(pending)
+        feeder = TaskFeeder(chunks, submit, control)
+        feeder.start()
+        received = 0
+        try:
+            while feeder.pending(received):
+                if control is not None and control.cancelled.is_set():
+                    raise JobCancelled()
+                try:
+                    future = results.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                received += 1
+                yield future.result()
+            feeder.finish()
+        finally:
+            feeder.stop()
+            self.jobs.remove(pending)
+            for future in list(pending):
+                future.cancel()
+
+def get_frame_pool(workers=None):
+    """Returns the shared frame pool, only restarting it when the worker count or the profiling changes."""
+    global _frame_pool
+    workers = workers or cpu_count()
+    if _frame_pool is not None and (_frame_pool.workers != workers or _frame_pool.profile != profile_setting() or not _frame_pool.is_alive()):
+        _frame_pool.close()
+        _frame_pool = None
+    if _frame_pool is None:
+        _frame_pool = FramePool(workers)
+    return _frame_pool
+
+def shutdown_frame_pool():
+    global _frame_pool
+    if _frame_pool is not None:
+        _frame_pool.close()
+        _frame_pool = None
+
+atexit.register(shutdown_frame_pool)
+
+def frame_chunks(frame_numbers, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Splits sorted frame numbers into (start, end) ranges of at most `chunk_size` consecutive frames."""
+    start = end = None
+    for frame_num in frame_numbers:
+        if start is not None and (frame_num != end or end - start >= chunk_size):
+            yield start, end
+            start = None
+        if start is None:
+            start = frame_num
+        end = frame_num + 1
+    if start is not None:
+        yield start, end
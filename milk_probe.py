@@ -0,0 +1,88 @@
+import os
+import json
+import functools
+import subprocess
+from collections import namedtuple
+from fractions import Fraction
+
+# What the converter needs to know about a video: frame size (as decoded, so rotated), frame rate, duration in seconds,
+# number of frames and whether it has an audio stream (None when that couldn't be probed).
+VideoInfo = namedtuple('VideoInfo', ['width', 'height', 'fps', 'duration', 'frame_count', 'has_audio'])
+
+def probe_video(video_path):
+    """Returns the VideoInfo of a video file, probed once and cached until the file changes."""
+    try:
+        stat = os.stat(video_path)
+    except OSError:
+        raise RuntimeError(f"Error opening video file {video_path}")
+    return _probe_cached(os.path.abspath(video_path), stat.st_size, stat.st_mtime)
+
+@functools.lru_cache(maxsize=64)
+def _probe_cached(video_path, size, mtime):
+    try:
+        return probe_with_ffprobe(video_path)
+    except FileNotFoundError:
+        # ffprobe comes with ffmpeg, but not with every build of it
+        return probe_with_opencv(video_path)
+
+def frame_rate(rate):
+    """Turns an ffprobe rate like '30000/1001' into a float, 0 when it's unknown."""
+    try:
+        return float(Fraction(rate))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return 0.0
+
+def probe_with_ffprobe(video_path):
+    """Reads all the stream metadata with a single ffprobe call, raises FileNotFoundError without ffprobe."""
+    command = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', video_path]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f"Error opening video file {video_path}: {result.stderr.strip()}")
+    return parse_ffprobe(json.loads(result.stdout), video_path)
+
+def rotation(stream):
+    """The rotation in degrees of an ffprobe video stream, from its display matrix or its older rotate tag."""
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(float(side_data['rotation']))
+    try:
+        return int(float(stream.get('tags', {}).get('rotate', 0)))
+    except ValueError:
+        return 0
+
+def parse_ffprobe(data, video_path=''):
+    """Builds a VideoInfo from ffprobe's JSON output (-show_format -show_streams)."""
+    streams = data.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        raise RuntimeError(f"Error opening video file {video_path}: no video stream")
+
+    fps = frame_rate(video.get('avg_frame_rate')) or frame_rate(video.get('r_frame_rate'))
+    duration = float(video.get('duration') or data.get('format', {}).get('duration') or 0)
+    if str(video.get('nb_frames', '')).isdigit():
+        frame_count = int(video['nb_frames'])
+    else:
+        # Some containers (mkv, webm) don't store it
+        frame_count = round(duration * fps)
+    has_audio = any(stream.get('codec_type') == 'audio' for stream in streams)
+    width, height = int(video['width']), int(video['height'])
+    if rotation(video) % 180:
+        # ffmpeg autorotates what it decodes, so a portrait phone video comes out height x width
+        width, height = height, width
+    return VideoInfo(width, height, fps, duration, frame_count, has_audio)
+
+def probe_with_opencv(video_path):
+    """Fallback for systems without ffprobe, OpenCV can't tell whether there's audio."""
+    # Imported here since it's slow to load and only needed without ffprobe
+    import cv2
+
+    vidcap = cv2.VideoCapture(video_path)
+    if not vidcap.isOpened():
+        raise RuntimeError(f"Error opening video file {video_path}")
+    width = int(vidcap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+    vidcap.release()
+    duration = frame_count / fps if fps else 0
+    return VideoInfo(width, height, fps, duration, frame_count, None)
@@ -0,0 +1,217 @@
+import os
+import glob
+import json
+import time
+import shutil
+import pstats
+import cProfile
+import tempfile
+import threading
+from contextlib import nullcontext
+from multiprocessing import util
+
+# Set while a run is profiled to the folder every process writes what it recorded to, so pool
+# workers record too whether they're forked or spawned. Ends in ':python' with cProfile on.
+PROFILE_ENV = 'MILK_PROFILE'
+
+# Seconds between cProfile dumps of a process, which can't be merged until they're on disk
+PYTHON_DUMP_INTERVAL = 2.0
+
+_session = None
+
+_no_stage = nullcontext()
+
+class ProfileSession:
+    """What one process records while a run is profiled: stage spans and, optionally, cProfile stats.
+
+    Everything is written to files in `trace_dir` named after the process, merged by stop_profiling.
+    """
+
+    def __init__(self, trace_dir, python=False, role='worker'):
+        self.trace_dir = trace_dir
+        self.role = role
+        self.pid = os.getpid()
+        self.events = []
+        self.lock = threading.Lock()
+        self.started = False
+        self.profiler = None
+        # cProfile only follows the thread that enables it
+        self.profiler_thread = threading.get_ident()
+        self.last_dump = time.time()
+        if python:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        # Also runs when a pool worker exits, where atexit handlers don't
+        self.finalizer = util.Finalize(None, self.flush, kwargs={'final': True}, exitpriority=10)
+
+    def record(self, name, start, duration, args):
+        self.events.append((name, start, duration, threading.get_native_id(), args))
+
+    def flush(self, final=False):
+        """Appends the spans recorded since the last flush to this process's file, every so often the cProfile stats too."""
+        with self.lock:
+            events, self.events = self.events, []
+            if events or not self.started:
+                with open(os.path.join(self.trace_dir, f'events-{self.pid}.jsonl'), 'a') as f:
+                    if not self.started:
+                        f.write(json.dumps({'process': self.role, 'pid': self.pid}) + '\n')
+                        self.started = True
+                    for name, start, duration, tid, args in events:
+                        f.write(json.dumps({'name': name, 'start': start, 'duration': duration, 'tid': tid, 'args': args}) + '\n')
+
+            if self.profiler is None or threading.get_ident() != self.profiler_thread and not final:
+                return
+            if final or time.time() - self.last_dump > PYTHON_DUMP_INTERVAL:
+                # Dumping stops the profiler, the stats keep adding up once it's enabled again
+                self.profiler.dump_stats(os.path.join(self.trace_dir, f'python-{self.pid}.prof'))
+                self.last_dump = time.time()
+                if final:
+                    self.profiler = None
+                else:
+                    self.profiler.enable()
+
+class Stage:
+    """Context manager timing one stage of the pipeline, see `stage`."""
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        session = _session
+        if session is not None:
+            session.record(self.name, self.start, time.time_ns() - self.start, self.args)
+
+def stage(name, **args):
+    """Times the code in a `with` block as a stage of the current process, costs nothing when not profiling."""
+    if _session is None:
+        return _no_stage
+    return Stage(name, args)
+
+def profile_setting():
+    """The profiling the worker processes started now would do, None when not profiling."""
+    return os.environ.get(PROFILE_ENV)
+
+def flush_profile():
+    """Writes out what this process recorded so far, pool workers call it after every task."""
+    if _session is not None:
+        _session.flush()
+
+def _start_from_environment():
+    global _session
+    if _session is not None and _session.pid != os.getpid():
+        # Inherited with a fork, its spans and stats belong to the parent
+        if _session.profiler is not None:
+            _session.profiler.disable()
+        _session.finalizer.cancel()
+        _session = None
+    setting = profile_setting()
+    if setting and _session is None:
+        python = setting.endswith(':python')
+        _session = ProfileSession(setting[:-len(':python')] if python else setting, python)
+
+def _after_fork(_):
+    _start_from_environment()
+
+_start_from_environment()
+util.register_after_fork(_after_fork, _after_fork)
+
+def start_profiling(python=False):
+    """Starts profiling this process and the pool workers started from now on, returns the trace folder.
+
+    Pool workers already running don't record anything, get_frame_pool starts new ones.
+    With `python`, every process also runs cProfile (in the thread that starts it).
+    """
+    global _session
+    trace_dir = tempfile.mkdtemp(prefix='milk-profile-')
+    os.environ[PROFILE_ENV] = trace_dir + (':python' if python else '')
+    _session = ProfileSession(trace_dir, python, role='main')
+    return trace_dir
+
+def stop_profiling(output_path):
+    """Stops profiling and merges what every process recorded into a Chrome trace at `output_path`.
+
+    Stop the pool workers first, they write the last of their spans as they exit. cProfile stats
+    are merged into the same path with a .pstats extension. Returns the stage_summary of the run.
+    """
+    global _session
+    session = _session
+    _session = None
+    os.environ.pop(PROFILE_ENV, None)
+    session.flush(final=True)
+    session.finalizer.cancel()
+
+    try:
+        processes, events = read_traces(session.trace_dir)
+        summary = stage_summary(processes, events)
+        write_chrome_trace(output_path, processes, events, summary)
+        stats_paths = sorted(glob.glob(os.path.join(session.trace_dir, 'python-*.prof')))
+        if stats_paths:
+            stats = pstats.Stats(*stats_paths)
+            stats.dump_stats(os.path.splitext(output_path)[0] + '.pstats')
+    finally:
+        shutil.rmtree(session.trace_dir, ignore_errors=True)
+    return summary
+
+def read_traces(trace_dir):
+    """Reads the spans of every process, returning {pid: role} and a list of span dicts with their pid."""
+    processes = {}
+    events = []
+    for path in glob.glob(os.path.join(trace_dir, 'events-*.jsonl')):
+        pid = int(os.path.basename(path)[7:-6])
+        with open(path) as f:
+            for line in f:
+                event = json.loads(line)
+                if 'process' in event:
+                    processes[pid] = event['process']
+                else:
+                    event['pid'] = pid
+                    events.append(event)
+    return processes, events
+
+def process_label(processes, pid):
+    return 'main' if processes.get(pid) == 'main' else f'worker {pid}'
+
+def stage_summary(processes, events):
+    """Adds up the time every process spent in every stage, as dicts sorted by process and time."""
+    totals = {}
+    for event in events:
+        key = (process_label(processes, event['pid']), event['name'])
+        count, duration = totals.get(key, (0, 0))
+        totals[key] = (count + 1, duration + event['duration'])
+    rows = [{'process': process, 'stage': name, 'count': count, 'seconds': duration / 1e9} for (process, name), (count, duration) in totals.items()]
+    rows.sort(key=lambda row: (row['process'] != 'main', row['process'], -row['seconds']))
+    return rows
+
+def write_chrome_trace(output_path, processes, events, summary):
+    """Saves spans in the Trace Event Format, which chrome://tracing and Perfetto open."""
+    origin = min((event['start'] for event in events), default=0)
+    trace_events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': process_label(processes, pid)}}
+        for pid in processes
+    ]
+    for event in events:
+        trace_events.append({
+            'name': event['name'],
+            'cat': 'milk',
+            'ph': 'X',
+            'ts': (event['start'] - origin) / 1000,
+            'dur': event['duration'] / 1000,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': event['args'],
+        })
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms', 'otherData': {'stages': summary}}, f)
+
+def format_stage_summary(summary):
+    """The stage summary as a table, one line per process and stage."""
+    lines = [f"{'process':<16} {'stage':<10} {'count':>7} {'seconds':>9} {'ms each':>8}"]
+    for row in summary:
+        lines.append(f"{row['process']:<16} {row['stage']:<10} {row['count']:>7} {row['seconds']:>9.2f} {row['seconds'] / row['count'] * 1000:>8.2f}")
+    return '\n'.join(lines)
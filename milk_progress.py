@@ -0,0 +1,191 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from milk_profile import stage
+
+class JobCancelled(Exception):
+    """Raised inside a conversion once its JobControl has been cancelled."""
+
+class JobControl:
+    """Lets another thread (the GUI) pause, resume or cancel a running conversion."""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.running = threading.Event()
+        self.running.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.running.set()
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def is_paused(self):
+        return not self.running.is_set()
+
+    def checkpoint(self):
+        """Blocks while the job is paused and raises JobCancelled once it has been cancelled."""
+        self.running.wait()
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+def suspend_processes(processes):
+    """Stops processes (ffmpeg, pool workers) while a job is paused, where the platform allows it."""
+    if hasattr(signal, 'SIGSTOP'):
+        for process in processes:
+            try:
+                os.kill(process.pid, signal.SIGSTOP)
+            except (ProcessLookupError, TypeError):
+                pass
+
+def resume_processes(processes):
+    if hasattr(signal, 'SIGCONT'):
+        for process in processes:
+            try:
+                os.kill(process.pid, signal.SIGCONT)
+            except (ProcessLookupError, TypeError):
+                pass
+
+def checkpoint_processes(control, processes):
+    """Runs `control.checkpoint()` on behalf of external processes: pauses them with the job and kills them on cancel."""
+    if control is None:
+        return
+    try:
+        if not control.is_paused():
+            control.checkpoint()
+            return
+        suspend_processes(processes)
+        try:
+            control.checkpoint()
+        finally:
+            resume_processes(processes)
+    except JobCancelled:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        raise
+
+class ProgressTracker:
+    """Turns the frame count of one pipeline stage into progress events.
+
+    Every event is a dict with the stage name, frames done and total, percent, fps, ETA in seconds,
+    elapsed seconds, the depth of the work queue (when there is one) and whether the stage is done.
+    """
+
+    def __init__(self, stage, total_frames, callback=None, interval=0.5):
+        self.stage = stage
+        self.total_frames = total_frames
+        self.callback = callback
+        self.interval = interval
+        self.start = time.time()
+        self.last_event = 0
+        self.frames_done = 0
+
+    def update(self, frames_done, queue_depth=None, done=False):
+        self.frames_done = frames_done
+        now = time.time()
+        if not self.callback or (not done and now - self.last_event < self.interval):
+            return
+        self.last_event = now
+        self.callback(self.event(frames_done, queue_depth, done, now - self.start))
+
+    def event(self, frames_done, queue_depth, done, elapsed):
+        fps = frames_done / elapsed if elapsed > 0 else 0
+        total = max(self.total_frames, frames_done)
+        if done:
+            total = frames_done
+        eta = (total - frames_done) / fps if fps else None
+        return {
+            'stage': self.stage,
+            'frames_done': frames_done,
+            'total_frames': total,
+            'percent': frames_done / total * 100 if total else 100,
+            'fps': fps,
+            'eta': eta,
+            'elapsed': elapsed,
+            'queue_depth': queue_depth,
+            'done': done,
+        }
+
+    def finish(self, frames_done=None):
+        self.update(self.frames_done if frames_done is None else frames_done, done=True)
+
+    def skip(self, frames_done):
+        """Reports the stage as done without timing it, when an earlier run already did its work."""
+        self.frames_done = frames_done
+        if self.callback:
+            self.callback(self.event(frames_done, None, True, 0))
+
+def ffmpeg_error(returncode, log, lines=20):
+    """Builds the error for a failed ffmpeg run from the end of its log (a file it wrote stderr to)."""
+    log.seek(0)
+    tail = log.read().decode(errors='replace').strip().splitlines()[-lines:]
+    return RuntimeError(f"ffmpeg failed with exit code {returncode}:\n" + '\n'.join(tail))
+
+def run_ffmpeg_with_progress(command, tracker, control=None):
+    """Runs an ffmpeg command, feeding the frame counter it reports with -progress to `tracker`.
+
+    Raises RuntimeError with the end of ffmpeg's log if it fails.
+    """
+    command = command[:1] + ['-progress', 'pipe:1', '-nostats'] + command[1:]
+    frames = 0
+    # A file rather than a pipe, so a chatty ffmpeg can never block on a full stderr
+    with stage(tracker.stage), tempfile.TemporaryFile() as log:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log, text=True)
+        try:
+            for line in process.stdout:
+                # ffmpeg reports about twice a second, which is how fast pause and cancel take effect
+                checkpoint_processes(control, [process])
+                key, _, value = line.strip().partition('=')
+                if key == 'frame' and value.isdigit():
+                    frames = int(value)
+                    tracker.update(frames)
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            raise ffmpeg_error(process.returncode, log)
+    tracker.finish(frames)
+
+def format_progress(event):
+    text = f"[{event['stage']}] {event['percent']:6.2f}% {event['frames_done']}/{event['total_frames']} frames, {event['fps']:.1f} fps"
+    if event['eta'] is not None and not event['done']:
+        text += f", ETA {event['eta']:.0f}s"
+    if event['queue_depth'] is not None:
+        text += f", queue {event['queue_depth']}"
+    return text
+
+def print_progress(event):
+    """Progress callback for the console, one line per stage that keeps updating."""
+    print(f"\r{format_progress(event):<80}", end='\n' if event['done'] else '', flush=True)
+
+def json_progress_writer(path, job=None):
+    """Returns a progress callback writing every event as a JSON line to `path` ('-' for stdout)."""
+    def write(event):
+        if job is not None:
+            event = dict(event, job=job)
+        line = json.dumps(event) + '\n'
+        if path == '-':
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        else:
+            with open(path, 'a') as f:
+                f.write(line)
+    return write
+
+def combine_callbacks(*callbacks):
+    """Returns one progress callback calling all the given ones, skipping None."""
+    callbacks = [callback for callback in callbacks if callback]
+    def call(event):
+        for callback in callbacks:
+            callback(event)
+    return call
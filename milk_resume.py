@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from milk_filter import MILK_BANDS, MILK_PALETTES, random_seed
+
+MANIFEST_NAME = 'manifest.json'
+
+# First and last bytes of a complete file, per frame format
+FRAME_MARKERS = {
+    '.jpg': (b'\xff\xd8', b'\xff\xd9'),
+    '.png': (b'\x89PNG\r\n\x1a\n', b'IEND\xaeB`\x82'),
+}
+
+def is_complete_frame(path):
+    """Checks a JPEG or PNG frame file starts and ends with its format's markers, so one cut short by a crash isn't reused."""
+    start, end = FRAME_MARKERS[os.path.splitext(path)[1]]
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(start)) != start:
+                return False
+            f.seek(-len(end), os.SEEK_END)
+            return f.read(len(end)) == end
+    except OSError:
+        return False
+
+def save_atomically(image, path, format='JPEG', **kwargs):
+    """Saves a PIL image under a temporary name and renames it, so `path` is either complete or missing."""
+    temp_path = path + '.part'
+    image.save(temp_path, format=format, **kwargs)
+    os.replace(temp_path, path)
+
+def source_signature(video_path, fps):
+    """Identifies the extracted frames: the same file, unchanged, extracted at the same FPS."""
+    stat = os.stat(video_path)
+    return {'video': os.path.abspath(video_path), 'size': stat.st_size, 'mtime': stat.st_mtime, 'fps': fps}
+
+def filter_signature(source, compression, effect, milk_type, quality, seed, temporal=False):
+    """Identifies the filtered frames, palette and bands included since custom milk types can change between runs."""
+    signature = {
+        'source': source,
+        'compression': compression,
+        'effect': effect,
+        'milk_type': milk_type,
+        'quality': quality if compression else None,
+        # Only the pointillism dithering draws from the seed
+        'seed': seed if effect else None,
+        'temporal': temporal,
+        'palette': MILK_PALETTES.get(milk_type),
+        'bands': MILK_BANDS.get(milk_type),
+    }
+    # Compare what was loaded from JSON against what would be written to it
+    return json.loads(json.dumps(signature))
+
+class ResumeManifest:
+    """Remembers which steps and frames of a conversion are done, in a work folder that outlives a crash.
+
+    The manifest is only a record: every frame it lists is checked on disk again before it is trusted.
+    """
+
+    def __init__(self, work_dir, save_interval=2.0):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, MANIFEST_NAME)
+        self.save_interval = save_interval
+        self.last_save = 0
+        self.data = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError):
+                # A manifest cut short is treated like a missing one, its frames are checked again anyway
+                self.data = {}
+        self.filtered = set(self.data.get('filtered', []))
+
+    def save(self, force=True):
+        now = time.time()
+        if not force and now - self.last_save < self.save_interval:
+            return
+        self.last_save = now
+        self.data['filtered'] = sorted(self.filtered)
+        temp_path = self.path + '.part'
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(temp_path, self.path)
+
+    @property
+    def source(self):
+        return self.data.get('extract')
+
+    def extraction_done(self, source, frames_folder):
+        return self.data.get('extract') == source and os.path.isdir(frames_folder)
+
+    def mark_extracted(self, source):
+        self.data['extract'] = source
+        self.save()
+
+    def temporal_seed(self):
+        """The seed the temporal mode dithers from when none is given, made up once and kept for the runs that resume it.
+
+        The frames a resumed run keeps and the ones it filters again have to share their noise.
+        """
+        if self.data.get('temporal_seed') is None:
+            self.data['temporal_seed'] = random_seed()
+            self.save()
+        return self.data['temporal_seed']
+
+    def filtered_frames(self, signature, input_folder, output_folder):
+        """Returns the frames already filtered with `signature`, forgetting the stale, missing or partial ones."""
+        if self.data.get('filter') != signature:
+            self.data['filter'] = signature
+            self.filtered = set()
+            if os.path.isdir(output_folder):
+                shutil.rmtree(output_folder)
+
+        os.makedirs(output_folder, exist_ok=True)
+        for filename in os.listdir(output_folder):
+            if filename.endswith('.part'):
+                os.remove(os.path.join(output_folder, filename))
+
+        done = set()
+        for frame_num in self.filtered:
+            frame_file = os.path.join(input_folder, f"frame{frame_num:06d}.jpg")
+            filtered_file = os.path.join(output_folder, f"frame{frame_num:06d}.png")
+            if os.path.exists(frame_file) and is_complete_frame(filtered_file):
+                done.add(frame_num)
+        self.filtered = done
+        self.save()
+        return done
+
+    def mark_filtered(self, frame_numbers):
+        self.filtered.update(frame_numbers)
+        self.save(force=False)
+
+@contextmanager
+def resumable_scratch(video_path, scratch_root=None):
+    """Yields a work folder tied to `video_path`, kept when the conversion fails so it can be resumed."""
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    root = scratch_root or os.path.dirname(os.path.abspath(video_path))
+    work_dir = os.path.join(root, f"{video_name}.milk-resume")
+    os.makedirs(work_dir, exist_ok=True)
+    yield work_dir
+    shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import milk_filter
+from milk_converter import ConvertOptions, MilkConverter
+from milk_filter import MAX_SUM, TemporalFilter, filter_array, filter_indices, frame_rng, milk_palette
+from milk_pipeline import FramePool
+
+# Whatever engine this process loaded, the tests switch between it and NumPy
+NATIVE = milk_filter.milk_native
+
+BLACK = (0, 0, 0)
+
+def original_colours(milk_type, R, G, B):
+    """The original per-pixel if/elif ladder, as (colour kept with probability 0.7, the other colour)."""
+    brightness = sum([R, G, B]) / 3
+    if milk_type == 1:
+        if brightness <= 25:
+            return BLACK, BLACK
+        elif brightness <= 70:
+            return BLACK, (102, 0, 31)
+        elif brightness < 120:
+            return (102, 0, 31), BLACK
+        elif brightness < 200:
+            return (102, 0, 31), (102, 0, 31)
+        elif brightness < 230:
+            return (137, 0, 146), (102, 0, 31)
+        else:
+            return (137, 0, 146), (137, 0, 146)
+    else:
+        if brightness <= 25:
+            return BLACK, BLACK
+        elif brightness <= 70:
+            return BLACK, (92, 36, 60)
+        elif brightness < 90:
+            return (92, 36, 60), BLACK
+        elif brightness < 150:
+            return (92, 36, 60), (92, 36, 60)
+        elif brightness < 200:
+            return (203, 43, 43), (92, 36, 60)
+        else:
+            return (203, 43, 43), (203, 43, 43)
+
+def sum_pixels():
+    """One (R, G, B) pixel for every R+G+B sum from 0 to 765."""
+    pixels = []
+    for total in range(MAX_SUM + 1):
+        R = min(255, total)
+        G = min(255, total - R)
+        pixels.append((R, G, total - R - G))
+    return np.array(pixels, dtype=np.uint8)
+
+@pytest.fixture(params=['numpy', 'native'])
+def engine(request, monkeypatch):
+    if request.param == 'native' and NATIVE is None:
+        pytest.skip("milk_native isn't built")
+    monkeypatch.setattr(milk_filter, 'milk_native', NATIVE if request.param == 'native' else None)
+    return request.param
+
+def random_frames(count, height=45, width=80, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (count, height, width, 3), dtype=np.uint8)
+
+@pytest.mark.parametrize('milk_type', [1, 2, 3])
+def test_without_effect_matches_the_original_ladder(engine, milk_type):
+    pixels = sum_pixels()
+    expected = np.array([original_colours(milk_type, *map(int, pixel))[0] for pixel in pixels], dtype=np.uint8)
+    frame = pixels.reshape(1, -1, 3)
+    assert np.array_equal(filter_array(frame, milk_type)[0], expected)
+    assert np.array_equal(milk_palette(milk_type)[filter_indices(frame, milk_type)[0]], expected)
+
+@pytest.mark.parametrize('milk_type', [1, 2, 3])
+def test_pointillism_matches_the_original_ladder(engine, milk_type):
+    pixels = sum_pixels()
+    # Every sum in its own column, 2000 times
+    frame = np.broadcast_to(pixels, (2000, len(pixels), 3)).copy()
+    filtered = filter_array(frame, milk_type, True, frame_rng(1, 1))
+    for total, pixel in enumerate(pixels):
+        kept, other = (np.array(colour, dtype=np.uint8) for colour in original_colours(milk_type, *map(int, pixel)))
+        column = filtered[:, total]
+        is_kept = (column == kept).all(axis=1)
+        assert (is_kept | (column == other).all(axis=1)).all(), f"R+G+B = {total}"
+        if not np.array_equal(kept, other):
+            assert abs(is_kept.mean() - milk_filter.POINTILLISM_PROBABILITY) < 0.05, f"R+G+B = {total}"
+
+def test_indices_match_colours(engine):
+    for milk_type in (1, 2):
+        for frame_num, frame in enumerate(random_frames(3), start=1):
+            indices = filter_indices(frame, milk_type, True, frame_rng(5, frame_num))
+            colours = filter_array(frame, milk_type, True, frame_rng(5, frame_num))
+            assert np.array_equal(milk_palette(milk_type)[indices], colours)
+
+def test_seeded_output_is_the_same_with_both_engines(monkeypatch):
+    if NATIVE is None:
+        pytest.skip("milk_native isn't built")
+    frames = random_frames(3, 61, 97)
+    outputs = []
+    for native in (NATIVE, None):
+        monkeypatch.setattr(milk_filter, 'milk_native', native)
+        outputs.append([filter_indices(frame, milk_type, True, frame_rng(7, frame_num))
+                        for milk_type in (1, 2) for frame_num, frame in enumerate(frames, start=1)])
+    assert all(np.array_equal(a, b) for a, b in zip(*outputs))
+
+def test_seeded_output_is_the_same_with_any_workers(engine):
+    frames = random_frames(12)
+    options = ConvertOptions(effect=True, seed=3, workers=1)
+    expected = list(MilkConverter(options).filter_frames(frames))
+    assert all(np.array_equal(a, filter_array(frame, 1, True, frame_rng(3, frame_num)))
+               for frame_num, (a, frame) in enumerate(zip(expected, frames), start=1))
+
+    with ThreadPoolExecutor(3) as executor:
+        assert all(np.array_equal(a, b) for a, b in zip(MilkConverter(options, executor).filter_frames(frames), expected))
+    # Forked now, the workers use the engine of this test
+    pool = FramePool(2)
+    try:
+        assert all(np.array_equal(a, b) for a, b in zip(MilkConverter(options, pool).filter_frames(frames), expected))
+    finally:
+        pool.close()
+
+def test_temporal_filter_is_the_same_with_both_engines(monkeypatch):
+    if NATIVE is None:
+        pytest.skip("milk_native isn't built")
+    # A still background with a moving block, so the NumPy engine redoes only some pixels
+    background = random_frames(1, 60, 90)[0]
+    frames = []
+    for frame_num in range(8):
+        frame = background.copy()
+        frame[frame_num * 5:frame_num * 5 + 20, 10:40] = random_frames(1, 20, 30, seed=frame_num + 1)[0]
+        frames.append(frame)
+
+    outputs = []
+    for native in (NATIVE, None):
+        monkeypatch.setattr(milk_filter, 'milk_native', native)
+        for milk_type in (1, 2):
+            temporal_filter = TemporalFilter(milk_type, True, seed=11)
+            outputs.append([temporal_filter.filter_indices(frame) for frame in frames])
+    native_outputs, numpy_outputs = outputs[:2], outputs[2:]
+    for native_frames, numpy_frames in zip(native_outputs, numpy_outputs):
+        assert all(np.array_equal(a, b) for a, b in zip(native_frames, numpy_frames))
@@ -1,229 +1,222 @@
 import os
-import random
-import subprocess
-import cv2
-from PIL import Image
-from multiprocessing import Process, cpu_count, current_process
 import argparse
-import shutil
+import signal
+import sys
 import time
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from milk_cache import DEFAULT_CACHE_SIZE, default_cache_dir
+from milk_converter import ConvertOptions, MilkConverter
+from milk_encoder import DEFAULT_ENCODER, ENCODER_PROFILES, encoder_profile
+from milk_filter import load_milk_types
+from milk_pipeline import DEFAULT_CHUNK_SIZE, preview_sheet, preview_video
+from milk_profile import format_stage_summary
+from milk_progress import combine_callbacks, json_progress_writer, print_progress
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+
+def find_batch_videos(batch_path):
+    """Lists the videos of a batch, given a directory or a manifest file with one video path per line."""
+    if os.path.isdir(batch_path):
+        return sorted(
+            os.path.join(batch_path, f) for f in os.listdir(batch_path)
+            if f.lower().endswith(VIDEO_EXTENSIONS) and not os.path.splitext(f)[0].endswith('_filtered')
+        )
+
+    manifest_dir = os.path.dirname(os.path.abspath(batch_path))
+    videos = []
+    with open(batch_path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                videos.append(os.path.join(manifest_dir, line))
+    return videos
+
+def message_stream(args):
+    """Where the messages for people go: stderr when stdout carries the JSON progress events."""
+    return sys.stderr if args.progress_json == '-' else sys.stdout
+
+def convert_batch_video(video_path, output_path, options, progress_json=None):
+    """Converts one video of a batch, returning the time it took."""
+    start = time.time()
+    progress_callback = json_progress_writer(progress_json, job=video_path) if progress_json else None
+    MilkConverter(options).convert(video_path, output_path, progress_callback=progress_callback)
+    return time.time() - start
+
+def run_batch(args):
+    """Converts every video of a batch without prompting, running several conversions at once."""
+    videos = find_batch_videos(args.video_path)
+    messages = message_stream(args)
+    if not videos:
+        print("No videos found for the batch.", file=messages)
+        return 1
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    compression = args.compression is not None
+    quality = args.compression if compression else 90
+    jobs = args.jobs or max(1, cpu_count() // 2)
+    # One filter worker per conversion, the conversions themselves keep the cores busy
+    options = command_line_options(args, milk_type=args.milk_type, effect=args.pointillism, compression=compression, quality=quality, fps=args.fps)._replace(mode='stream', workers=1, profile=None)
+
+    # Each conversion streams through its own ffmpeg decoder and encoder, so running several at once
+    # keeps decoding, filtering and encoding of different videos overlapping on all cores
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for video_path in videos:
+            video_name, video_ext = os.path.splitext(os.path.basename(video_path))
+            output_dir = args.output_dir or os.path.dirname(video_path)
+            output_path = os.path.join(output_dir, f"{video_name}_filtered{video_ext}")
+            future = executor.submit(convert_batch_video, video_path, output_path, options, args.progress_json)
+            futures[future] = video_path
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            video_path = futures[future]
+            try:
+                elapsed = future.result()
+                print(f"[{done}/{len(videos)}] {video_path} done in {elapsed:.1f}s", file=messages)
+            except Exception as error:
+                failed += 1
+                print(f"[{done}/{len(videos)}] {video_path} FAILED: {error}", file=messages)
+
+    print(f"Batch finished: {len(videos) - failed} converted, {failed} failed.", file=messages)
+    return 1 if failed else 0
+
+def run_preview(args):
+    """Filters a few downscaled frames of the video with the given options and saves them as one image."""
+    start = time.time()
+    compression = args.compression is not None
+    quality = args.compression if compression else 90
+    previews = preview_video(args.video_path, count=args.preview, compression=compression, effect=args.pointillism, milk_type=args.milk_type, quality=quality, seed=args.seed)
+    sheet = preview_sheet(previews)
+    if sheet is None:
+        print(f"Could not decode any frame from {args.video_path}.")
+        return 1
+
+    video_name, _ = os.path.splitext(args.video_path)
+    preview_path = f"{video_name}_preview.png"
+    sheet.save(preview_path)
+    print(f"Preview of {len(previews)} frames saved to {preview_path} in {time.time() - start:.2f}s")
+    return 0
+
+def cache_size(args):
+    return int(args.cache_size * 1024 ** 3)
+
+def command_line_encoder(args):
+    return encoder_profile(args.encoder, preset=args.preset, crf=args.crf, tune=args.tune, threads=args.encoder_threads, audio=args.audio)
+
+def command_line_mode(args):
+    if args.stream:
+        return 'stream'
+    return 'segments' if args.segments is not None else 'frames'
+
+def command_line_options(args, **settings):
+    """ConvertOptions from the command line flags, plus the filter settings given."""
+    return ConvertOptions(seed=args.seed, temporal=args.temporal, mode=command_line_mode(args), workers=args.workers, segments=args.segments or None,
+                          chunk_size=args.chunk_size, cache_dir=args.cache, cache_size=cache_size(args), encoder=command_line_encoder(args),
+                          scratch_root=args.scratch_dir, resume=args.resume, profile=args.profile, profile_python=args.profile_python, **settings)
+
+def ask(prompt, messages=sys.stdout):
+    """Like input(), but shows the prompt on `messages`."""
+    messages.write(prompt)
+    messages.flush()
+    return input()
+
+def ask_filter_options(messages=sys.stdout):
+    """Asks the user for the milk type, pointillism and compression settings."""
+    milk_type = int(ask("Select milk type (1 or 2): ", messages))
+    pointillism = ask("Apply pointillism effect? (y/n): ", messages).lower() == 'y'
+    compression = ask("Apply compression? (y/n): ", messages).lower() == 'y'
 
-def get_video_fps(video_path):
-    """Gets the FPS of a video file."""
-    vidcap = cv2.VideoCapture(video_path)
-    fps = vidcap.get(cv2.CAP_PROP_FPS)
-    vidcap.release()
-    return fps
-
-def extract_frames_with_ffmpeg(video_path, output_folder, fps):
-    """Extracts frames from a video file using ffmpeg."""
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    else:
-        # Ensure the folder is empty
-        for filename in os.listdir(output_folder):
-            file_path = os.path.join(output_folder, filename)
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-
-    print(f"Extracting frames at {fps} FPS...")
-    command = f"ffmpeg -y -i {video_path} -vf fps={fps} {output_folder}/frame%06d.jpg"
-    subprocess.call(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-def probably(prob):
-    """Returns True with a probability equal to `prob`."""
-    return random.random() < prob
-
-def apply_filter(image, compression, effect, milk_type, calidad, frame_path):
-    """Applies a custom filter to an image."""
-    if effect:
-        punt = 70
-    else:
-        punt = 100
-
-    imag = image.convert('RGB')
-    #Sacar el nombre del archivo dada su ruta absoluta, quita la extension
-    nombre = os.path.splitext(os.path.basename(frame_path))[0]
-
+    quality = 90
     if compression:
-        # Guarda la imagen con el mismo nombre en la carpeta 'filtered_frames'
-        output_folder = 'filtered_frames'
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-        output_path = os.path.join(output_folder, f"{nombre}.jpg")
-        imag.save(output_path, quality=100-calidad)
-        imag = Image.open(output_path)
-
-    width, height = imag.size
-
-    for x in range(width):
-        for y in range(height):
-            pixelRGB = imag.getpixel((x, y))
-            R, G, B = pixelRGB
-            brightness = sum([R, G, B]) / 3
-            new_pixel = (0, 0, 0, 255)  # Default black
-            if milk_type == 1:
-                if brightness <= 25:
-                    new_pixel = (0, 0, 0, 255)
-                elif brightness <= 70:
-                    new_pixel = (0, 0, 0, 255) if probably(punt/100) else (102, 0, 31, 255)
-                elif brightness < 120:
-                    new_pixel = (102, 0, 31, 255) if probably(punt/100) else (0, 0, 0, 255)
-                elif brightness < 200:
-                    new_pixel = (102, 0, 31, 255)
-                elif brightness < 230:
-                    new_pixel = (137, 0, 146, 255) if probably(punt/100) else (102, 0, 31, 255)
-                else:
-                    new_pixel = (137, 0, 146, 255)
-            else:
-                if brightness <= 25:
-                    new_pixel = (0, 0, 0, 255)
-                elif brightness <= 70:
-                    new_pixel = (0, 0, 0, 255) if probably(punt/100) else (92, 36, 60, 255)
-                elif brightness < 90:
-                    new_pixel = (92, 36, 60, 255) if probably(punt/100) else (0, 0, 0, 255)
-                elif brightness < 150:
-                    new_pixel = (92, 36, 60, 255)
-                elif brightness < 200:
-                    new_pixel = (203, 43, 43, 255) if probably(punt/100) else (92, 36, 60, 255)
-                else:
-                    new_pixel = (203, 43, 43, 255)
-
-            imag.putpixel((x, y), new_pixel)
-
-    return imag
-
-def apply_filter_to_frame_range(start, end, input_folder, output_folder, compression, effect, milk_type, quality):
-    """Applies the filter to a range of frames and saves them to the output folder."""
-    for frame_num in range(start, end):
-        frame_path = os.path.join(input_folder, f"frame{frame_num:06d}.jpg")
-        if os.path.exists(frame_path):
-            image = Image.open(frame_path)
-            filtered_image = apply_filter(image, compression, effect, milk_type, quality, frame_path)
-            filtered_frame_path = os.path.join(output_folder, f"frame{frame_num:06d}.jpg")
-            filtered_image.save(filtered_frame_path)
-
-def apply_filter_to_frames(input_folder, output_folder, compression=False, effect=False, milk_type=1, quality=90):
-    """Applies the custom filter to each extracted frame and saves them to the output folder."""
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    else:
-        # Ensure the folder is empty
-        for filename in os.listdir(output_folder):
-            file_path = os.path.join(output_folder, filename)
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-
-    frame_files = [f for f in os.listdir(input_folder) if f.endswith('.jpg')]
-    frame_files.sort(key=lambda x: int(x[5:-4]))
-    total_frames = len(frame_files)
-
-    num_processes = min(cpu_count(), total_frames)
-    frames_per_process = total_frames // num_processes
-
-    processes = []
-    for i in range(num_processes):
-        start = i * frames_per_process
-        end = (i + 1) * frames_per_process if i != num_processes - 1 else total_frames
-        process = Process(target=apply_filter_to_frame_range, args=(start, end, input_folder, output_folder, compression, effect, milk_type, quality))
-        processes.append(process)
-        process.start()
-
-    # Track progress
-    while any(process.is_alive() for process in processes):
-        og_files = len(os.listdir(input_folder))
-        filtered_files = len(os.listdir(output_folder))
-        if og_files > 0:
-            progress = (filtered_files / og_files) * 100
-            print(f"\rProgress: {progress:.2f}%", end='', flush=True)
-        time.sleep(1)
-
-    for process in processes:
-        process.join()
-
-    print("\rProgress: 100.00% - FINISH!")
-
-def frames_to_video(input_folder, output_path, fps, original_video_path):
-    """Converts a sequence of frames into a video file using ffmpeg and retains the original audio."""
-    frame_files = [f for f in os.listdir(input_folder) if f.endswith('.jpg')]
-    
-    if not frame_files:
-        print("No frames found in the input folder.")
-        return
-    
-    # Ensure the frames are sorted correctly
-    frame_files.sort(key=lambda x: int(x[5:-4]))
-    
-    # Create a temporary text file listing all frames in the correct order
-    with open('frames.txt', 'w') as f:
-        for frame_file in frame_files:
-            frame_path = os.path.join(input_folder, frame_file)
-            f.write(f"file '{frame_path}'\n")
-
-    # Construct the ffmpeg command
-    command = [
-        'ffmpeg',
-        '-y',
-        '-f', 'concat',
-        '-safe', '0',
-        '-r', str(fps),
-        '-i', 'frames.txt',
-        '-i', original_video_path,
-        '-c:v', 'libx264',
-        '-c:a', 'aac',
-        '-strict', 'experimental',
-        '-pix_fmt', 'yuv420p',
-        '-shortest',  # Ensure the video and audio lengths match
-        output_path
-    ]
-
-    # Execute the ffmpeg command
-    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    
-    # Remove the temporary text file
-    os.remove('frames.txt')
+        quality = int(ask("Enter compression quality (0-100, where 0 is best quality): ", messages))
+
+    return milk_type, pointillism, compression, quality
 
 def main():
     parser = argparse.ArgumentParser(description='Process a local video file and apply filters.')
-    parser.add_argument('video_path', type=str, help='Path to the local video file')
+    parser.add_argument('video_path', type=str, help='Path to the local video file (or a directory/manifest file with --batch)')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the pointillism effect, for reproducible output')
+    parser.add_argument('--stream', action='store_true', help='Pipe raw frames between ffmpeg processes instead of writing them to disk')
+    parser.add_argument('--segments', type=int, nargs='?', const=0, default=None, metavar='N', help='Split the video at keyframes into N segments (default: one per worker) that are decoded, filtered and encoded in parallel, without writing frames to disk')
+    parser.add_argument('--workers', type=int, default=None, help='Number of filter worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Number of frames each worker takes from the queue at a time')
+    parser.add_argument('--progress-json', type=str, default=None, metavar='FILE', help='Also append every progress event as a JSON line to FILE (- for stdout only)')
+    parser.add_argument('--palettes', type=str, default=None, metavar='FILE', help='JSON file with extra milk types (palette and brightness bands)')
+    parser.add_argument('--resume', action='store_true', help='Keep the frame folders next to the video (or in --scratch-dir) until the conversion succeeds, and only redo the missing frames when run again after a crash')
+    parser.add_argument('--temporal', action='store_true', help='Keep the pointillism pattern still where the video does not change (less flicker, smaller videos)')
+    parser.add_argument('--cache', type=str, nargs='?', const=default_cache_dir(), default=None, metavar='DIR', help=f'Reuse filtered frames for identical input frames, within this run and across runs (default folder: {default_cache_dir()})')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_CACHE_SIZE / 1024 ** 3, metavar='GB', help='Size limit of the frame cache, the least recently used frames are deleted past it (default: 2)')
+    parser.add_argument('--scratch-dir', type=str, default=None, help='Where to create the temporary frame folders, e.g. a tmpfs like /dev/shm (default: the system temp folder)')
+    parser.add_argument('--profile', type=str, default=None, metavar='FILE', help='Time every stage in every process and save the timeline to FILE as a Chrome trace (open it in chrome://tracing or Perfetto), not in batch mode')
+    parser.add_argument('--profile-python', action='store_true', help='With --profile, also run cProfile in every process and save the merged stats next to FILE (.pstats)')
+
+    encoding = parser.add_argument_group('encoding', 'How the filtered video is encoded, a profile plus optional overrides')
+    encoding.add_argument('--encoder', choices=ENCODER_PROFILES, default=DEFAULT_ENCODER, help=f'Encoder profile (default: {DEFAULT_ENCODER})')
+    encoding.add_argument('--preset', type=str, default=None, help='Encoder preset, e.g. ultrafast, veryfast, medium, slow')
+    encoding.add_argument('--crf', type=int, default=None, help='Constant rate factor, lower is better quality and bigger files')
+    encoding.add_argument('--tune', type=str, default=None, help='Encoder tune, e.g. animation (x264)')
+    encoding.add_argument('--encoder-threads', type=int, default=None, help='Threads used by the encoder (default: chosen by ffmpeg)')
+    encoding.add_argument('--audio', type=str, default=None, help="Audio codec, or 'copy' to keep the original audio as is (the default, except VP9 uses libopus)")
+
+    batch = parser.add_argument_group('batch and preview mode', 'Convert many videos (or preview one) without prompting, using these options')
+    batch.add_argument('--preview', type=int, nargs='?', const=4, default=None, metavar='FRAMES', help='Only filter a few downscaled frames (4 by default) and save them side by side with the originals')
+    batch.add_argument('--batch', action='store_true', help='Treat video_path as a directory of videos or a manifest file with one video path per line')
+    batch.add_argument('--fps', type=float, default=None, help='FPS for frame extraction (default: the FPS of each video)')
+    batch.add_argument('--milk-type', type=int, default=1, help='Milk type (1, 2 or one added with --palettes)')
+    batch.add_argument('--pointillism', action='store_true', help='Apply the pointillism effect')
+    batch.add_argument('--compression', type=int, default=None, metavar='QUALITY', help='Apply compression with this quality (0-100, where 0 is best quality)')
+    batch.add_argument('--output-dir', type=str, default=None, help='Folder for the filtered videos (default: next to each video)')
+    batch.add_argument('--jobs', type=int, default=None, help='Number of videos converted at the same time (default: half the CPUs)')
     args = parser.parse_args()
 
-    video_path = args.video_path
-    video_name, video_ext = os.path.splitext(video_path)
-    filtered_video_path = f"{video_name}_filtered{video_ext}"
+    # Turn a kill into a normal exit so the scratch folder still gets cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
 
-    customize_fps = input("Would you like to customize the FPS for frame extraction? (y/n): ").lower() == 'y'
-    if customize_fps:
-        fps = int(input("Enter the desired FPS for frame extraction: "))
-    else:
-        fps = get_video_fps(video_path)
+    if args.palettes:
+        load_milk_types(args.palettes)
+        # Worker processes load it again from the environment when they start
+        os.environ['MILK_PALETTES'] = os.path.abspath(args.palettes)
 
-    extract_frames_with_ffmpeg(video_path, 'og', fps)
+    # Fails early on a bad encoder profile
+    command_line_encoder(args)
 
-    milk_type = int(input("Select milk type (1 or 2): "))
-    pointillism = input("Apply pointillism effect? (y/n): ").lower() == 'y'
-    compression = input("Apply compression? (y/n): ").lower() == 'y'
+    if args.batch:
+        # Every video of a batch streams with a single filter worker
+        unsupported = [flag for flag, used in (('--segments', args.segments is not None), ('--workers', args.workers is not None),
+                                               ('--resume', args.resume), ('--profile', args.profile is not None)) if used]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} can't be used with --batch, which converts each video in stream mode with one worker (see --jobs)")
+        sys.exit(run_batch(args))
 
-    quality = 90
-    if compression:
-        quality = int(input("Enter compression quality (0-100, where 0 is best quality): "))
-
-    apply_filter_to_frames('og', 'filtered_frames', compression=compression, effect=pointillism, milk_type=milk_type, quality=quality)
+    if args.preview:
+        sys.exit(run_preview(args))
 
-    for file in os.listdir('og'):
-        os.remove(f'og/{file}')
+    messages = message_stream(args)
+    progress_callback = print_progress
+    if args.progress_json == '-':
+        progress_callback = json_progress_writer('-')
+    elif args.progress_json:
+        progress_callback = combine_callbacks(print_progress, json_progress_writer(args.progress_json))
 
-    frames_to_video('filtered_frames', filtered_video_path, fps, video_path)
-
-    for file in os.listdir('filtered_frames'):
-        os.remove(f'filtered_frames/{file}')
+    video_path = args.video_path
+    video_name, video_ext = os.path.splitext(video_path)
+    filtered_video_path = f"{video_name}_filtered{video_ext}"
 
-    os.rmdir('filtered_frames')
-    os.rmdir('og')
+    customize_fps = ask("Would you like to customize the FPS for frame extraction? (y/n): ", messages).lower() == 'y'
+    fps = None
+    if customize_fps:
+        fps = int(ask("Enter the desired FPS for frame extraction: ", messages))
+
+    milk_type, pointillism, compression, quality = ask_filter_options(messages)
+    options = command_line_options(args, milk_type=milk_type, effect=pointillism, compression=compression, quality=quality, fps=fps)
+    summary = MilkConverter(options).convert(video_path, filtered_video_path, progress_callback=progress_callback)
+    if summary is not None:
+        print(format_stage_summary(summary), file=messages)
+        print(f"Profile saved to {args.profile}", file=messages)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,227 +1,63 @@
 import os
-import sys
-import cv2
-import random
-from PIL import Image, ImageTk
-import subprocess
-import multiprocessing
-from multiprocessing import Process, cpu_count, freeze_support
-import shutil
-import time
+from PIL import ImageTk
+from multiprocessing import freeze_support
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
+from milk_converter import ConvertOptions, MilkConverter
+from milk_encoder import DEFAULT_ENCODER, ENCODER_PROFILES, encoder_profile
+from milk_filter import MILK_PALETTES
+from milk_pipeline import preview_sheet, preview_video
+from milk_progress import JobCancelled, JobControl, format_progress
 
-def get_video_fps(video_path):
-    """Gets the FPS of a video file."""
-    vidcap = cv2.VideoCapture(video_path)
-    fps = vidcap.get(cv2.CAP_PROP_FPS)
-    vidcap.release()
-    return fps
-
-def extract_frames_with_ffmpeg(video_path, output_folder, fps):
-    """Extracts frames from a video file using ffmpeg."""
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    else:
-        # Ensure the folder is empty
-        for filename in os.listdir(output_folder):
-            file_path = os.path.join(output_folder, filename)
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-
-    command = f"ffmpeg -y -i {video_path} -vf fps={fps} {output_folder}/frame%06d.jpg"
-    subprocess.call(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-def probably(prob):
-    """Returns True with a probability equal to `prob`."""
-    return random.random() < prob
-
-def apply_filter(image, compression, effect, milk_type, calidad, frame_path):
-    """Applies a custom filter to an image."""
-    if effect:
-        punt = 70
-    else:
-        punt = 100
-
-    imag = image.convert('RGB')
-    nombre = os.path.splitext(os.path.basename(frame_path))[0]
-
-    if compression:
-        output_folder = 'filtered_frames'
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-        output_path = os.path.join(output_folder, f"{nombre}.jpg")
-        imag.save(output_path, quality=100-calidad)
-        imag = Image.open(output_path)
-
-    width, height = imag.size
-
-    for x in range(width):
-        for y in range(height):
-            pixelRGB = imag.getpixel((x, y))
-            R, G, B = pixelRGB
-            brightness = sum([R, G, B]) / 3
-            new_pixel = (0, 0, 0, 255)
-
-            if milk_type == 1:
-                if brightness <= 25:
-                    new_pixel = (0, 0, 0, 255)
-                elif brightness <= 70:
-                    new_pixel = (0, 0, 0, 255) if probably(punt/100) else (102, 0, 31, 255)
-                elif brightness < 120:
-                    new_pixel = (102, 0, 31, 255) if probably(punt/100) else (0, 0, 0, 255)
-                elif brightness < 200:
-                    new_pixel = (102, 0, 31, 255)
-                elif brightness < 230:
-                    new_pixel = (137, 0, 146, 255) if probably(punt/100) else (102, 0, 31, 255)
-                else:
-                    new_pixel = (137, 0, 146, 255)
-            else:
-                if brightness <= 25:
-                    new_pixel = (0, 0, 0, 255)
-                elif brightness <= 70:
-                    new_pixel = (0, 0, 0, 255) if probably(punt/100) else (92, 36, 60, 255)
-                elif brightness < 90:
-                    new_pixel = (92, 36, 60, 255) if probably(punt/100) else (0, 0, 0, 255)
-                elif brightness < 150:
-                    new_pixel = (92, 36, 60, 255)
-                elif brightness < 200:
-                    new_pixel = (203, 43, 43, 255) if probably(punt/100) else (92, 36, 60, 255)
-                else:
-                    new_pixel = (203, 43, 43, 255)
-
-            imag.putpixel((x, y), new_pixel)
-
-    return imag
-
-def apply_filter_to_frame_range(start, end, input_folder, output_folder, compression, effect, milk_type, quality):
-    """Applies the filter to a range of frames and saves them to the output folder."""
-    for frame_num in range(start, end):
-        frame_path = os.path.join(input_folder, f"frame{frame_num:06d}.jpg")
-        if os.path.exists(frame_path):
-            image = Image.open(frame_path)
-            filtered_image = apply_filter(image, compression, effect, milk_type, quality, frame_path)
-            filtered_frame_path = os.path.join(output_folder, f"frame{frame_num:06d}.jpg")
-            filtered_image.save(filtered_frame_path)
-
-def apply_filter_to_frames(input_folder, output_folder, compression=False, effect=False, milk_type=1, quality=90, progress_callback=None):
-    """Applies the custom filter to each extracted frame and saves them to the output folder."""
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    else:
-        # Ensure the folder is empty
-        for filename in os.listdir(output_folder):
-            file_path = os.path.join(output_folder, filename)
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-
-    frame_files = [f for f in os.listdir(input_folder) if f.endswith('.jpg')]
-    frame_files.sort(key=lambda x: int(x[5:-4]))
-    total_frames = len(frame_files)
-
-    num_processes = min(cpu_count(), total_frames)
-    frames_per_process = total_frames // num_processes
-
-    processes = []
-    for i in range(num_processes):
-        start = i * frames_per_process
-        end = (i + 1) * frames_per_process if i != num_processes - 1 else total_frames
-        process = Process(target=apply_filter_to_frame_range, args=(start, end, input_folder, output_folder, compression, effect, milk_type, quality))
-        processes.append(process)
-        process.start()
-
-    while any(process.is_alive() for process in processes):
-        og_files = len(os.listdir(input_folder))
-        filtered_files = len(os.listdir(output_folder))
-        if og_files > 0:
-            progress = (filtered_files / og_files) * 100
-            if progress_callback:
-                progress_callback(int(progress))
-        time.sleep(1)
-
-    for process in processes:
-        process.join()
-
-    if progress_callback:
-        progress_callback(100)
-
-def frames_to_video(input_folder, output_path, fps, original_video_path):
-    """Converts a sequence of frames into a video file using ffmpeg and retains the original audio."""
-    frame_files = [f for f in os.listdir(input_folder) if f.endswith('.jpg')]
-    
-    if not frame_files:
-        return
-    
-    frame_files.sort(key=lambda x: int(x[5:-4]))
-    
-    with open('frames.txt', 'w') as f:
-        for frame_file in frame_files:
-            frame_path = os.path.join(input_folder, frame_file)
-            f.write(f"file '{frame_path}'\n")
-
-    command = [
-        'ffmpeg',
-        '-y',
-        '-f', 'concat',
-        '-safe', '0',
-        '-r', str(fps),
-        '-i', 'frames.txt',
-        '-i', original_video_path,
-        '-c:v', 'libx264',
-        '-c:a', 'aac',
-        '-strict', 'experimental',
-        '-pix_fmt', 'yuv420p',
-        '-shortest',
-        output_path
-    ]
-
-    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    os.remove('frames.txt')
-
-class FilterThread:
-    def __init__(self, video_path, fps, milk_type, pointillism, compression, quality, progress_callback, finish_callback):
+class FilterThread(threading.Thread):
+    """Runs a conversion off the Tk main loop, reporting back through a queue of (kind, payload) messages."""
+
+    def __init__(self, video_path, options, messages, control):
+        super().__init__(daemon=True)
         self.video_path = video_path
-        self.fps = fps
-        self.milk_type = milk_type
-        self.pointillism = pointillism
-        self.compression = compression
-        self.quality = quality
-        self.progress_callback = progress_callback
-        self.finish_callback = finish_callback
+        self.options = options
+        self.messages = messages
+        self.control = control
+
+    def progress_callback(self, event):
+        self.messages.put(('progress', event))
 
     def run(self):
-        extract_frames_with_ffmpeg(self.video_path, 'og', self.fps)
-        apply_filter_to_frames('og', 'filtered_frames', compression=self.compression, effect=self.pointillism, milk_type=self.milk_type, quality=self.quality, progress_callback=self.progress_callback)
-        
-        for file in os.listdir('og'):
-            os.remove(f'og/{file}')
+        try:
+            self.convert()
+        except JobCancelled:
+            self.messages.put(('cancelled', None))
+        except Exception as error:
+            self.messages.put(('error', str(error)))
+        else:
+            self.messages.put(('finished', None))
 
+    def convert(self):
         video_name, video_ext = os.path.splitext(self.video_path)
         filtered_video_path = f"{video_name}_filtered{video_ext}"
-
-        frames_to_video('filtered_frames', filtered_video_path, self.fps, self.video_path)
-
-        for file in os.listdir('filtered_frames'):
-            os.remove(f'filtered_frames/{file}')
-
-        os.rmdir('filtered_frames')
-        os.rmdir('og')
-
-        self.finish_callback()
+        summary = MilkConverter(self.options).convert(self.video_path, filtered_video_path, progress_callback=self.progress_callback, control=self.control)
+        if summary is not None:
+            self.messages.put(('profile', self.options.profile))
 
 class VideoFilterApp(tk.Tk):
     def __init__(self):
         super().__init__()
         self.video_path = None
+        self.filter_thread = None
+        self.preview_thread = None
+        self.preview_image = None
+        self.control = None
+        self.profile_path = None
+        self.messages = queue.Queue()
         self.initUI()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.after(100, self.poll_messages)
 
     def initUI(self):
         self.title("Milk Inside a Bag of Milk Video Filter")
-        self.geometry("400x600")
+        self.geometry("400x880")
         self.configure(bg="#1e1e2e")  # Dark blue background color
 
         font = ("Arial", 14, "bold")
@@ -243,7 +79,8 @@ class VideoFilterApp(tk.Tk):
         self.milk_type_label = tk.Label(self, text="Select Milk Type:", font=font, fg="#f1fa8c", bg="#1e1e2e")
         self.milk_type_label.pack(pady=5)
 
-        self.milk_type_combo = ttk.Combobox(self, values=["Milk Type 1", "Milk Type 2"], font=button_font)
+        self.milk_types = sorted(MILK_PALETTES)
+        self.milk_type_combo = ttk.Combobox(self, values=[f"Milk Type {milk_type}" for milk_type in self.milk_types], font=button_font)
         self.milk_type_combo.current(0)
         self.milk_type_combo.pack(pady=5)
 
@@ -251,6 +88,10 @@ class VideoFilterApp(tk.Tk):
         self.pointillism_checkbox = tk.Checkbutton(self, text="Apply Pointillism Effect", variable=self.pointillism_checkbox_var, bg="#1e1e2e", fg="#f1fa8c", selectcolor="#1e1e2e")
         self.pointillism_checkbox.pack(pady=5)
 
+        self.temporal_checkbox_var = tk.IntVar()
+        self.temporal_checkbox = tk.Checkbutton(self, text="Steady Pointillism (less flicker)", variable=self.temporal_checkbox_var, bg="#1e1e2e", fg="#f1fa8c", selectcolor="#1e1e2e")
+        self.temporal_checkbox.pack(pady=5)
+
         self.compression_checkbox_var = tk.IntVar()
         self.compression_checkbox = tk.Checkbutton(self, text="Apply Compression", variable=self.compression_checkbox_var, command=self.toggle_quality_spinbox, bg="#1e1e2e", fg="#f1fa8c", selectcolor="#1e1e2e")
         self.compression_checkbox.pack(pady=5)
@@ -258,14 +99,47 @@ class VideoFilterApp(tk.Tk):
         self.quality_spinbox = tk.Spinbox(self, from_=0, to=100, state="disabled", font=button_font, bg="#44475a", fg="#f8f8f2")
         self.quality_spinbox.pack(pady=5)
 
+        self.stream_checkbox_var = tk.IntVar()
+        self.stream_checkbox = tk.Checkbutton(self, text="Stream Frames (no temporary files)", variable=self.stream_checkbox_var, bg="#1e1e2e", fg="#f1fa8c", selectcolor="#1e1e2e")
+        self.stream_checkbox.pack(pady=5)
+
+        self.profile_checkbox_var = tk.IntVar()
+        self.profile_checkbox = tk.Checkbutton(self, text="Profile Run (saves a trace next to the video)", variable=self.profile_checkbox_var, bg="#1e1e2e", fg="#f1fa8c", selectcolor="#1e1e2e")
+        self.profile_checkbox.pack(pady=5)
+
+        self.encoder_label = tk.Label(self, text="Encoder:", font=button_font, fg="#f1fa8c", bg="#1e1e2e")
+        self.encoder_label.pack(pady=2)
+
+        self.encoder_combo = ttk.Combobox(self, values=list(ENCODER_PROFILES), state="readonly", font=button_font)
+        self.encoder_combo.set(DEFAULT_ENCODER)
+        self.encoder_combo.pack(pady=5)
+
         self.progress_bar = ttk.Progressbar(self, orient="horizontal", length=300, mode="determinate")
         self.progress_bar.pack(pady=5)
 
         self.progress_label = tk.Label(self, text="Progress: 0.00%", font=font, fg="#f1fa8c", bg="#1e1e2e")
         self.progress_label.pack(pady=5)
 
-        self.start_btn = tk.Button(self, text="Start Processing", command=self.start_processing, font=button_font, bg="#50fa7b", fg="#282a36")
-        self.start_btn.pack(pady=10)
+        self.status_label = tk.Label(self, text="", font=("Arial", 9), fg="#f8f8f2", bg="#1e1e2e")
+        self.status_label.pack(pady=2)
+
+        self.start_buttons = tk.Frame(self, bg="#1e1e2e")
+        self.start_buttons.pack(pady=10)
+
+        self.preview_btn = tk.Button(self.start_buttons, text="Preview", command=self.start_preview, font=button_font, bg="#8be9fd", fg="#282a36")
+        self.preview_btn.pack(side="left", padx=5)
+
+        self.start_btn = tk.Button(self.start_buttons, text="Start Processing", command=self.start_processing, font=button_font, bg="#50fa7b", fg="#282a36")
+        self.start_btn.pack(side="left", padx=5)
+
+        self.job_buttons = tk.Frame(self, bg="#1e1e2e")
+        self.job_buttons.pack(pady=5)
+
+        self.pause_btn = tk.Button(self.job_buttons, text="Pause", command=self.toggle_pause, state="disabled", font=button_font, bg="#f1fa8c", fg="#282a36")
+        self.pause_btn.pack(side="left", padx=5)
+
+        self.cancel_btn = tk.Button(self.job_buttons, text="Cancel", command=self.cancel_processing, state="disabled", font=button_font, bg="#ff5555", fg="#282a36")
+        self.cancel_btn.pack(side="left", padx=5)
 
     def toggle_fps_spinbox(self):
         if self.fps_checkbox_var.get():
@@ -284,37 +158,160 @@ class VideoFilterApp(tk.Tk):
         if self.video_path:
             self.select_video_btn.config(text=f"Selected: {os.path.basename(self.video_path)}")
 
-    def update_progress(self, progress):
-        self.progress_bar["value"] = progress
-        self.progress_label.config(text=f"Progress: {progress:.2f}%")
-        self.update_idletasks()
+    def update_progress(self, event):
+        self.progress_bar["value"] = event['percent']
+        self.progress_label.config(text=f"{event['stage'].capitalize()}: {event['percent']:.2f}%")
+        self.status_label.config(text=format_progress(event))
+
+    def poll_messages(self):
+        """Drains the worker thread's messages on the Tk loop, the only place widgets get touched."""
+        while True:
+            try:
+                kind, payload = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                self.update_progress(payload)
+            elif kind == 'finished':
+                self.processing_finished()
+            elif kind == 'cancelled':
+                self.processing_cancelled()
+            elif kind == 'error':
+                self.processing_failed(payload)
+            elif kind == 'preview':
+                self.show_preview(payload)
+            elif kind == 'profile':
+                self.profile_path = payload
+
+        self.after(100, self.poll_messages)
+
+    def job_done(self):
+        self.filter_thread = None
+        self.control = None
+        self.start_btn.config(state="normal")
+        self.pause_btn.config(state="disabled", text="Pause")
+        self.cancel_btn.config(state="disabled")
 
     def processing_finished(self):
+        self.job_done()
         self.progress_label.config(text="Progress: 100.00% - FINISH!")
-        self.start_btn.config(state="normal")
-        messagebox.showinfo("Processing Finished", "The video has been processed successfully!")
+        message = "The video has been processed successfully!"
+        if self.profile_path:
+            message += f"\n\nThe profile was saved to {self.profile_path}"
+            self.profile_path = None
+        messagebox.showinfo("Processing Finished", message)
+
+    def processing_cancelled(self):
+        self.job_done()
+        self.progress_bar["value"] = 0
+        self.progress_label.config(text="Cancelled")
+        self.status_label.config(text="")
+
+    def processing_failed(self, error):
+        self.job_done()
+        self.progress_label.config(text="Failed")
+        messagebox.showerror("Processing Failed", f"The video could not be processed:\n{error}")
+
+    def filter_options(self):
+        """Returns the milk type, pointillism, compression and quality picked in the window."""
+        milk_type = self.milk_types[max(self.milk_type_combo.current(), 0)]
+        pointillism = bool(self.pointillism_checkbox_var.get())
+        compression = bool(self.compression_checkbox_var.get())
+        quality = int(self.quality_spinbox.get())
+        return milk_type, pointillism, compression, quality
+
+    def start_preview(self):
+        if not self.video_path:
+            messagebox.showwarning("No Video Selected", "Please select a video file to preview.")
+            return
+        if self.preview_thread is not None:
+            return
+
+        milk_type, pointillism, compression, quality = self.filter_options()
+        self.preview_btn.config(state="disabled")
+        self.status_label.config(text="Rendering preview...")
+        self.preview_thread = threading.Thread(
+            target=self.render_preview, args=(self.video_path, milk_type, pointillism, compression, quality), daemon=True
+        )
+        self.preview_thread.start()
+
+    def render_preview(self, video_path, milk_type, pointillism, compression, quality):
+        """Runs on the preview thread, a few downscaled frames keep it around a second."""
+        try:
+            previews = preview_video(video_path, count=4, max_width=320, compression=compression, effect=pointillism, milk_type=milk_type, quality=quality)
+            self.messages.put(('preview', preview_sheet(previews)))
+        except Exception as e:
+            self.messages.put(('preview', e))
+
+    def show_preview(self, sheet):
+        self.preview_thread = None
+        self.preview_btn.config(state="normal")
+        self.status_label.config(text="")
+        if sheet is None or isinstance(sheet, Exception):
+            messagebox.showerror("Preview Failed", f"The video could not be previewed:\n{sheet or 'no frame could be decoded'}")
+            return
+
+        max_height = int(self.winfo_screenheight() * 0.8)
+        if sheet.height > max_height:
+            sheet = sheet.resize((sheet.width * max_height // sheet.height, max_height))
+
+        window = tk.Toplevel(self)
+        window.title(f"Preview: {os.path.basename(self.video_path)}")
+        window.configure(bg="#1e1e2e")
+        # Tk only shows the image while a reference to it is kept around
+        self.preview_image = ImageTk.PhotoImage(sheet)
+        tk.Label(window, image=self.preview_image, bg="#1e1e2e").pack()
+
+    def toggle_pause(self):
+        if self.control is None:
+            return
+        if self.control.is_paused():
+            self.control.resume()
+            self.pause_btn.config(text="Pause")
+        else:
+            self.control.pause()
+            self.pause_btn.config(text="Resume")
+            self.progress_label.config(text="Paused")
+
+    def cancel_processing(self):
+        if self.control is not None:
+            self.control.cancel()
+            self.cancel_btn.config(state="disabled")
+            self.pause_btn.config(state="disabled")
+            self.progress_label.config(text="Cancelling...")
+
+    def on_close(self):
+        self.cancel_processing()
+        if self.filter_thread is not None:
+            self.filter_thread.join(timeout=5)
+        self.destroy()
 
     def start_processing(self):
         if not self.video_path:
             messagebox.showwarning("No Video Selected", "Please select a video file to process.")
             return
 
-        fps = get_video_fps(self.video_path)
+        fps = None
         if self.fps_checkbox_var.get():
             fps = int(self.fps_spinbox.get())
 
-        milk_type = 1 if self.milk_type_combo.current() == 0 else 2
-        pointillism = bool(self.pointillism_checkbox_var.get())
-        compression = bool(self.compression_checkbox_var.get())
-        quality = int(self.quality_spinbox.get())
+        milk_type, pointillism, compression, quality = self.filter_options()
+        video_name, _ = os.path.splitext(self.video_path)
+        options = ConvertOptions(
+            milk_type=milk_type, effect=pointillism, compression=compression, quality=quality, fps=fps,
+            temporal=bool(self.temporal_checkbox_var.get()),
+            mode='stream' if self.stream_checkbox_var.get() else 'frames',
+            encoder=encoder_profile(self.encoder_combo.get() or DEFAULT_ENCODER),
+            profile=f"{video_name}_profile.json" if self.profile_checkbox_var.get() else None,
+        )
 
         self.start_btn.config(state="disabled")
+        self.pause_btn.config(state="normal", text="Pause")
+        self.cancel_btn.config(state="normal")
 
-        self.filter_thread = FilterThread(
-            self.video_path, fps, milk_type, pointillism, compression, quality,
-            progress_callback=self.update_progress, finish_callback=self.processing_finished
-        )
-        self.after(100, self.filter_thread.run)
+        self.control = JobControl()
+        self.filter_thread = FilterThread(self.video_path, options, self.messages, self.control)
+        self.filter_thread.start()
 
 def main():
     app = VideoFilterApp()
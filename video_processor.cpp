@@ -5,6 +5,7 @@
 #include <thread>
 #include <vector>
 #include <random>
+#include "milk_kernel.hpp"
 
 namespace fs = std::filesystem;
 
@@ -38,19 +39,19 @@ void extractFrames(const std::string& videoPath, const std::string& outputFolder
     }
 }
 
-bool probably(double prob) {
-    static std::random_device rd;
-    static std::mt19937 gen(rd());
-    std::bernoulli_distribution d(prob);
-    return d(gen);
+// Every frame gets its own pointillism pattern, derived from the run's seed and the frame number
+// so the threads never share a random generator
+uint64_t frameSeed(uint64_t runSeed, int frameNum) {
+    uint64_t z = runSeed + (static_cast<uint64_t>(frameNum) + 1) * 0x9E3779B97F4A7C15ULL;
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return z ^ (z >> 31);
 }
 
-cv::Mat applyFilter(const cv::Mat& image, bool compression, bool effect, int milkType, int quality, const std::string& framePath) {
-    int punt = effect ? 70 : 100;
-
+cv::Mat applyFilter(const cv::Mat& image, bool compression, bool effect, int milkType, int quality, const std::string& framePath, uint64_t seed) {
     cv::Mat imag;
-    if (image.channels() == 3) {
-        cv::cvtColor(image, imag, cv::COLOR_BGR2RGB);
+    if (image.channels() == 1) {
+        cv::cvtColor(image, imag, cv::COLOR_GRAY2BGR);
     } else {
         imag = image.clone();
     }
@@ -64,63 +65,20 @@ cv::Mat applyFilter(const cv::Mat& image, bool compression, bool effect, int mil
         imag = cv::imread(outputPath);
     }
 
-    int width = imag.cols;
-    int height = imag.rows;
-
-    for (int x = 0; x < width; ++x) {
-        for (int y = 0; y < height; ++y) {
-            cv::Vec3b pixelRGB = imag.at<cv::Vec3b>(y, x);
-            int R = pixelRGB[0];
-            int G = pixelRGB[1];
-            int B = pixelRGB[2];
-            int brightness = (R + G + B) / 3;
-            cv::Vec4b new_pixel(0, 0, 0, 255);  // Default black
-
-            if (milkType == 1) {
-                if (brightness <= 25) {
-                    new_pixel = cv::Vec4b(0, 0, 0, 255);
-                } else if (brightness <= 70) {
-                    new_pixel = (probably(punt / 100.0)) ? cv::Vec4b(0, 0, 0, 255) : cv::Vec4b(102, 0, 31, 255);
-                } else if (brightness < 120) {
-                    new_pixel = (probably(punt / 100.0)) ? cv::Vec4b(102, 0, 31, 255) : cv::Vec4b(0, 0, 0, 255);
-                } else if (brightness < 200) {
-                    new_pixel = cv::Vec4b(102, 0, 31, 255);
-                } else if (brightness < 230) {
-                    new_pixel = (probably(punt / 100.0)) ? cv::Vec4b(137, 0, 146, 255) : cv::Vec4b(102, 0, 31, 255);
-                } else {
-                    new_pixel = cv::Vec4b(137, 0, 146, 255);
-                }
-            } else {
-                if (brightness <= 25) {
-                    new_pixel = cv::Vec4b(0, 0, 0, 255);
-                } else if (brightness <= 70) {
-                    new_pixel = (probably(punt / 100.0)) ? cv::Vec4b(0, 0, 0, 255) : cv::Vec4b(92, 36, 60, 255);
-                } else if (brightness < 90) {
-                    new_pixel = (probably(punt / 100.0)) ? cv::Vec4b(92, 36, 60, 255) : cv::Vec4b(0, 0, 0, 255);
-                } else if (brightness < 150) {
-                    new_pixel = cv::Vec4b(92, 36, 60, 255);
-                } else if (brightness < 200) {
-                    new_pixel = (probably(punt / 100.0)) ? cv::Vec4b(203, 43, 43, 255) : cv::Vec4b(92, 36, 60, 255);
-                } else {
-                    new_pixel = cv::Vec4b(203, 43, 43, 255);
-                }
-            }
-
-            imag.at<cv::Vec3b>(y, x) = cv::Vec3b(new_pixel[0], new_pixel[1], new_pixel[2]);
-        }
-    }
+    // The kernel reads the image row by row and writes the palette straight in BGR order
+    cv::Mat filtered(imag.rows, imag.cols, CV_8UC3);
+    milk::filterFrame(imag.data, filtered.data, imag.cols, imag.rows, imag.step, filtered.step,
+                      imag.channels(), milkType, effect, true, seed, 1);
 
-    cv::cvtColor(imag, imag, cv::COLOR_RGB2BGR);
-
-    return imag;
+    return filtered;
 }
 
-void processFrameRange(int startFrame, int endFrame, const std::string& inputFolder, const std::string& outputFolder, int milkType, int quality, bool effect) {
+void processFrameRange(int startFrame, int endFrame, const std::string& inputFolder, const std::string& outputFolder, int milkType, int quality, bool effect, uint64_t runSeed) {
     for (int frameNum = startFrame; frameNum <= endFrame; ++frameNum) {
         std::string framePath = inputFolder + "/frame" + std::to_string(frameNum) + ".jpg";
         cv::Mat frame = cv::imread(framePath);
         if (!frame.empty()) {
-            cv::Mat filteredFrame = applyFilter(frame, true, effect, milkType, quality, framePath);
+            cv::Mat filteredFrame = applyFilter(frame, true, effect, milkType, quality, framePath, frameSeed(runSeed, frameNum));
             std::string outputFramePath = outputFolder + "/frame" + std::to_string(frameNum) + ".jpg";
             cv::imwrite(outputFramePath, filteredFrame);
         }
@@ -144,10 +102,14 @@ void processFramesWithThreads(const std::string& inputFolder, const std::string&
     int totalFrames = frameFiles.size();
     int framesPerThread = totalFrames / numThreads;
 
+    // Drawn once here, std::random_device isn't guaranteed to be safe to call from several threads
+    std::random_device rd;
+    uint64_t runSeed = (static_cast<uint64_t>(rd()) << 32) | rd();
+
     for (int i = 0; i < numThreads; ++i) {
         int startFrame = i * framesPerThread;
         int endFrame = (i == numThreads - 1) ? totalFrames - 1 : (i + 1) * framesPerThread - 1;
-        threads.emplace_back(processFrameRange, startFrame, endFrame, inputFolder, outputFolder, milkType, quality, effect);
+        threads.emplace_back(processFrameRange, startFrame, endFrame, inputFolder, outputFolder, milkType, quality, effect, runSeed);
     }
 
     for (auto& t : threads) {